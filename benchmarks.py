@@ -0,0 +1,224 @@
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+import warnings
+from collections import Counter
+from typing import List, Optional, Tuple
+
+from functions import Term, SumOfTerms, NoCommonNumbersWarning, multiply_elementary_terms, multiply_single_terms, \
+    merge_concatenation_chains, cobound, fourfold, build_term
+
+# The example quadruple from functions_test.py, used as a template for the fourfold workloads
+FOURFOLD_TEMPLATE = (
+    ((({10}, {4, 8, 9}),),),
+    ((({4}, {1, 2, 3}),),),
+    ((({7}, {3, 5, 6}),), (({7}, {4, 5, 6}),)),
+    ((({13}, {7, 11, 12}),),),
+)
+FOURFOLD_TEMPLATE_NUMBERS = 13
+
+
+class NumberPool:
+    """ Source of fresh numbers, so that generated terms only share the numbers they are meant to share. """
+    def __init__(self, rng: random.Random, start: int = 1):
+        self.rng = rng
+        self.next_number = start
+
+    def take(self, count: int) -> List[int]:
+        numbers = list(range(self.next_number, self.next_number + count))
+        self.next_number += count
+        self.rng.shuffle(numbers)
+        return numbers
+
+
+def random_elementary_term(rng: random.Random, pool: NumberPool,
+                           subscript_size: Tuple[int, int] = (2, 3), superscript_size: Tuple[int, int] = (1, 1)):
+    """ Elementary term with fresh numbers. """
+    subscript = pool.take(rng.randint(*subscript_size))
+    superscript = pool.take(rng.randint(*superscript_size))
+    return Term(superscript=set(superscript), subscript=set(subscript))
+
+
+def random_elementary_pair(rng: random.Random, pool: NumberPool) -> Tuple[Term, Term]:
+    """ Two elementary terms sharing exactly one number, picked so that every rule
+        of multiply_elementary_terms (including the zero ones) gets exercised. """
+    shared_number = pool.take(1)[0]
+    first_sub, second_sub = pool.take(rng.randint(1, 2)), pool.take(rng.randint(1, 2))
+    first_super, second_super = pool.take(1), pool.take(1)
+    placement = rng.randrange(4)
+    if placement == 0:
+        first_super, second_sub = [shared_number], second_sub + [shared_number]
+    elif placement == 1:
+        second_super, first_sub = [shared_number], first_sub + [shared_number]
+    elif placement == 2:
+        first_sub, second_sub = first_sub + [shared_number], [shared_number]
+    else:
+        first_sub, second_sub = first_sub + [shared_number], second_sub + [shared_number]
+    return (Term(superscript=set(first_super), subscript=set(first_sub)),
+            Term(superscript=set(second_super), subscript=set(second_sub)))
+
+
+def random_chain_nodes(rng: random.Random, pool: NumberPool, depth: int, branching: float = 0.0,
+                       leaf_superscript: bool = True) -> List[Tuple[int, Counter, Counter]]:
+    """ Nodes of random_chain() as build_term() takes them. """
+    first_node = random_elementary_term(rng, pool)
+    nodes = [(-1, first_node.subscript, first_node.superscript)]
+    for level in range(1, depth):
+        node = random_elementary_term(rng, pool)
+        subscript, superscript = node.subscript, node.superscript
+        if level == depth - 1 and not leaf_superscript:
+            subscript, superscript = subscript + superscript, Counter()
+        parent = rng.choice(range(len(nodes))) if rng.random() < branching else len(nodes) - 1
+        nodes.append((parent, subscript, superscript))
+    return nodes
+
+
+def random_chain(rng: random.Random, pool: NumberPool, depth: int, branching: float = 0.0,
+                 leaf_superscript: bool = True) -> Term:
+    """ Concatenated chain of `depth` nodes with fresh numbers. With branching > 0, every node
+        after the first is attached to a random earlier node with that probability instead of the last one.
+        Without a leaf superscript, the last node is the cobound-applicable one. """
+    return build_term(random_chain_nodes(rng, pool, depth, branching, leaf_superscript))
+
+
+def random_chain_pair(rng: random.Random, pool: NumberPool, depth: int) -> Tuple[Term, Term, int]:
+    """ Two chains of the given depth with exactly one number in common, placed so that the nodes
+        containing it have a nonzero elementary product. Return the chains and the common number. """
+    second_nodes = random_chain_nodes(rng, pool, depth)
+    common_number = rng.choice(list(rng.choice(second_nodes)[1]))
+    first_nodes = random_chain_nodes(rng, pool, depth)
+    multiplied_index = rng.randrange(depth)
+    parent, subscript, _ = first_nodes[multiplied_index]
+    first_nodes[multiplied_index] = (parent, subscript, Counter({common_number: 1}))
+    return build_term(first_nodes), build_term(second_nodes), common_number
+
+
+def random_sum(rng: random.Random, pool: NumberPool, width: int, depth: int = 1,
+               leaf_superscript: bool = True) -> SumOfTerms:
+    """ Sum of `width` distinct chains of the given depth. """
+    return SumOfTerms(random_chain(rng, pool, depth, leaf_superscript=leaf_superscript) for _ in range(width))
+
+
+def random_fourfold_inputs(rng: random.Random, width: int) -> Tuple[SumOfTerms, ...]:
+    """ Quadruple of sums of `width` summands each, made of relabelled copies of the template quadruple.
+        Every copy uses its own numbers (relabelled preserving their order, which cobound relies on),
+        so the products within a copy are those of the template and the products across copies are zero. """
+    inputs = [SumOfTerms() for _ in FOURFOLD_TEMPLATE]
+    next_number = 1
+    for _ in range(width):
+        numbers = sorted(rng.sample(range(next_number, next_number + 3 * FOURFOLD_TEMPLATE_NUMBERS),
+                                    FOURFOLD_TEMPLATE_NUMBERS))
+        next_number += 3 * FOURFOLD_TEMPLATE_NUMBERS
+        for template_sum, input_sum in zip(FOURFOLD_TEMPLATE, inputs):
+            for ((superscript, subscript),) in template_sum:
+                input_sum.add_term(Term(superscript={numbers[number - 1] for number in superscript},
+                                        subscript={numbers[number - 1] for number in subscript}))
+    return tuple(inputs)
+
+
+def prepare_workload(name: str, size: int, seed: int):
+    """ Return a function running the benchmark once. The inputs are never modified, so they are generated once. """
+    rng = random.Random(f'{name}-{size}-{seed}')
+    pool = NumberPool(rng)
+    if name == 'multiply_elementary_terms':
+        pairs = [random_elementary_pair(rng, pool) for _ in range(size)]
+        return lambda: [multiply_elementary_terms(first, second) for first, second in pairs]
+    if name == 'multiply_single_terms':
+        first_chain, second_chain, _ = random_chain_pair(rng, pool, size)
+        return lambda: multiply_single_terms(first_chain, second_chain)
+    if name == 'merge_concatenation_chains':
+        first_chain, second_chain, common_number = random_chain_pair(rng, pool, size)
+        product = multiply_elementary_terms(first_chain.search_term_by_number(common_number),
+                                            second_chain.search_term_by_number(common_number))
+        product_node = product.terms[0] if isinstance(product, SumOfTerms) else product
+        return lambda: merge_concatenation_chains(first_chain, second_chain, product_node, common_number)
+    if name == 'cobound':
+        input_sum = random_sum(rng, pool, size, depth=3, leaf_superscript=False)
+        return lambda: cobound(input_sum)
+    if name == 'fourfold':
+        inputs = random_fourfold_inputs(rng, size)
+        return lambda: fourfold(*inputs)
+    raise ValueError(f'Unknown benchmark: {name}')
+
+
+DEFAULT_SIZES = {
+    'multiply_elementary_terms': [100, 1000, 10000],
+    'multiply_single_terms': [2, 8, 32, 128],
+    'merge_concatenation_chains': [2, 8, 32, 128],
+    'cobound': [10, 100, 1000],
+    'fourfold': [1, 4, 16],
+}
+
+
+def run_benchmark(name: str, size: int, seed: int = 0, repeat: int = 5) -> dict:
+    """ Time a benchmark `repeat` times and measure its peak traced memory in one extra run. """
+    run = prepare_workload(name, size, seed)
+    timings = list()
+    # Products with nothing in common are expected in the workloads; keep their warnings out of the output
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', NoCommonNumbersWarning)
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - start)
+        tracemalloc.start()
+        try:
+            run()
+            _, peak_memory = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return {
+        'benchmark': name,
+        'size': size,
+        'seed': seed,
+        'repeat': repeat,
+        'best_seconds': min(timings),
+        'mean_seconds': sum(timings) / len(timings),
+        'peak_memory_bytes': peak_memory,
+    }
+
+
+def run_benchmarks(names: Optional[List[str]] = None, sizes: Optional[List[int]] = None,
+                   seed: int = 0, repeat: int = 5) -> dict:
+    """ Run the size sweeps of the selected benchmarks and return the results with run metadata. """
+    results = list()
+    for name in names or DEFAULT_SIZES:
+        for size in sizes or DEFAULT_SIZES[name]:
+            results.append(run_benchmark(name, size, seed=seed, repeat=repeat))
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark term multiplication, cobound and fourfold.')
+    parser.add_argument('--benchmark', action='append', choices=list(DEFAULT_SIZES), dest='names',
+                        help='benchmark to run (repeatable, default: all)')
+    parser.add_argument('--size', action='append', type=int, dest='sizes',
+                        help='workload size (repeatable, default: a sweep per benchmark)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(names=args.names, sizes=args.sizes, seed=args.seed, repeat=args.repeat)
+    for result in report['results']:
+        print(f'{result["benchmark"]:>28} size={result["size"]:<6} best={result["best_seconds"]:.6f}s '
+              f'mean={result["mean_seconds"]:.6f}s peak={result["peak_memory_bytes"]}B', file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
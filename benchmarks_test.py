@@ -0,0 +1,43 @@
+import random
+
+from benchmarks import NumberPool, random_chain, random_chain_pair, random_elementary_pair, \
+    random_fourfold_inputs, run_benchmarks
+from functions import cobound, count_bits, fourfold, multiply_single_terms
+
+
+class TestGenerators:
+    def test_generators_are_seeded(self):
+        first_chain = random_chain(random.Random(1), NumberPool(random.Random(1)), depth=5)
+        second_chain = random_chain(random.Random(1), NumberPool(random.Random(1)), depth=5)
+        assert first_chain == second_chain
+
+    def test_elementary_pairs_share_one_number(self):
+        rng = random.Random(0)
+        pool = NumberPool(rng)
+        for _ in range(100):
+            first, second = random_elementary_pair(rng, pool)
+            assert count_bits(first.canonical.numbers_mask & second.canonical.numbers_mask) == 1
+
+    def test_chain_pairs_have_nonzero_products(self):
+        rng = random.Random(0)
+        pool = NumberPool(rng)
+        for depth in range(1, 10):
+            first_chain, second_chain, _ = random_chain_pair(rng, pool, depth)
+            assert not multiply_single_terms(first_chain, second_chain).is_zero
+
+    def test_cobound_applicable_chains(self):
+        rng = random.Random(0)
+        chain = random_chain(rng, NumberPool(rng), depth=4, leaf_superscript=False)
+        assert not cobound(chain).is_zero
+
+    def test_fourfold_inputs(self):
+        x12, x23, x34, x13, x24, x14 = fourfold(*random_fourfold_inputs(random.Random(0), width=3))
+        assert len(x24) == 3
+        assert len(x14) == 6
+
+
+class TestBenchmarks:
+    def test_report(self):
+        report = run_benchmarks(names=['fourfold', 'cobound'], sizes=[2], repeat=1)
+        assert [result['benchmark'] for result in report['results']] == ['fourfold', 'cobound']
+        assert all(result['peak_memory_bytes'] > 0 for result in report['results'])
@@ -0,0 +1,154 @@
+import argparse
+import sys
+import time
+from typing import Union, Tuple, Iterable, Iterator
+
+from functions import Term, SumOfTerms, Instrumentation, ProductCache, PersistentProductCache, CoefficientRing, \
+    set_coefficient_ring, fourfold_batch
+from notation import NotationError, parse
+from serialization import TermReader, TermWriter
+
+EXAMPLE_QUADRUPLE = 'e^{6}_{1,3,5}; e^{7}_{2,4,6}; e^{10}_{7,8,9}; e^{10}_{11,12,13}'
+OUTPUT_FORMATS = ('str', 'repr', 'binary')
+Quadruple = Tuple[Union[Term, SumOfTerms], ...]
+
+
+def read_quadruples(lines: Iterable[str], source_name: str = '<stdin>') -> Iterator[Quadruple]:
+    """ Parse quadruples written one per line, as the four inputs in the notation of Term.__str__
+        separated by semicolons. Blank lines and lines starting with # are skipped. """
+    for line_number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        inputs = line.split(';')
+        if len(inputs) != 4:
+            raise ValueError(f'{source_name}:{line_number}: expected 4 inputs separated by ";", found {len(inputs)}')
+        try:
+            yield tuple(parse(x) for x in inputs)
+        except NotationError as error:
+            raise ValueError(f'{source_name}:{line_number}: {error}') from error
+
+
+def read_binary_quadruples(stream) -> Iterator[Quadruple]:
+    """ Group the values of a binary stream (see serialization.py) into quadruples. """
+    quadruple = list()
+    for value in TermReader(stream):
+        quadruple.append(value)
+        if len(quadruple) == 4:
+            yield tuple(quadruple)
+            quadruple = list()
+    if quadruple:
+        raise ValueError(f'The binary input ends with an incomplete quadruple of {len(quadruple)} values')
+
+
+def read_input_files(paths: Iterable[str], binary: bool) -> Iterator[Quadruple]:
+    """ Quadruples from the files in order, read lazily; '-' stands for the standard input. """
+    for path in paths:
+        if path == '-':
+            yield from read_binary_quadruples(sys.stdin.buffer) if binary else read_quadruples(sys.stdin)
+        else:
+            with open(path, 'rb' if binary else 'r') as input_file:
+                yield from read_binary_quadruples(input_file) if binary else read_quadruples(input_file, path)
+
+
+def write_results(results: Iterable[Quadruple], output_format: str, stream) -> int:
+    """ Write the results of every quadruple as they come, returning the number of quadruples.
+        The text formats write the six results of a quadruple on one line, in the order of fourfold(),
+        separated by semicolons; the binary format writes them as six consecutive values. """
+    if output_format == 'binary':
+        writer = TermWriter(stream)
+    count = 0
+    for quadruple_results in results:
+        if output_format == 'binary':
+            for result in quadruple_results:
+                writer.write(result)
+        else:
+            to_string = repr if output_format == 'repr' else str
+            stream.write('; '.join(to_string(result) for result in quadruple_results) + '\n')
+        count += 1
+    stream.flush()
+    return count
+
+
+def format_report(count: int, elapsed: float, instrumentation: Instrumentation) -> str:
+    """ Throughput and the total time spent in every stage (entry and cobound) of the fourfold products. """
+    lines = [f'{count} quadruples in {elapsed:.3f} s ({count / elapsed if elapsed else 0:.1f} quadruples/s)']
+    stage_timings = [(key, timing) for key, timing in instrumentation.timings.items() if key[0] in ('entry', 'cobound')]
+    for key, (seconds, calls) in sorted(stage_timings,
+                                        key=lambda item: (item[0][2] - item[0][1], item[0][1], item[0][0] != 'entry')):
+        stage, i, j = key
+        label = f'x{i}{j}' if stage == 'entry' else f'{stage} of x{i}{j}'
+        lines.append(f'  {label:<14} {seconds:10.6f} s in {calls} calls')
+    if instrumentation.warning_count:
+        lines.append(f'  {instrumentation.warning_count} products of terms without numbers in common')
+    return '\n'.join(lines)
+
+
+def non_negative_int(text: str) -> int:
+    number = int(text)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f'must not be negative: {number}')
+    return number
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Evaluate fourfold() over quadruples of inputs. '
+                                                 'Text input has one quadruple per line: four sums in the notation '
+                                                 'of the output (e.g. e^{10}_{4,8,9}~e^{3}_{1,2}), separated by ";".')
+    parser.add_argument('inputs', nargs='*', help='input files ("-" for the standard input, which is the default)')
+    parser.add_argument('--example', action='store_true', help='evaluate the built-in example quadruple instead')
+    parser.add_argument('--input-format', choices=('text', 'binary'), default='text')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='str', dest='output_format',
+                        help='output format (default: str)')
+    parser.add_argument('--output', help='write the results to this file instead of the standard output')
+    parser.add_argument('--jobs', type=non_negative_int, default=0,
+                        help='worker processes (default: 0, evaluate in this process)')
+    parser.add_argument('--max-pending', type=non_negative_int,
+                        help='quadruples in flight in the worker pool (default: 2 * jobs)')
+    parser.add_argument('--cache-size', type=non_negative_int,
+                        help='product cache size, 0 to disable (default: 65536, or 1000000 with a cache file)')
+    parser.add_argument('--cache-file', help='keep the products in this sqlite file, shared across runs and workers')
+    parser.add_argument('--modulus', type=int, help='reduce the coefficients modulo this number (e.g. 2 for Z/2)')
+    parser.add_argument('--quiet', action='store_true', help='do not report throughput and timings')
+    args = parser.parse_args(argv)
+    try:
+        ring = CoefficientRing(args.modulus) if args.modulus is not None else None
+    except ValueError as error:
+        parser.error(str(error))
+
+    binary_input = args.input_format == 'binary'
+    if args.example:
+        quadruples = read_quadruples([EXAMPLE_QUADRUPLE], '<example>')
+    else:
+        quadruples = read_input_files(args.inputs or ['-'], binary_input)
+    if args.cache_size == 0:
+        cache = None
+    elif args.cache_file:
+        cache = PersistentProductCache(args.cache_file, maxsize=args.cache_size or 1000000)
+    else:
+        cache = ProductCache(maxsize=args.cache_size or 65536)
+    instrumentation = Instrumentation()
+    results = fourfold_batch(quadruples, max_workers=args.jobs, max_pending=args.max_pending,
+                             cache=cache, instrumentation=instrumentation)
+
+    start = time.perf_counter()
+    previous_ring = set_coefficient_ring(ring)
+    try:
+        if args.output:
+            with open(args.output, 'wb' if args.output_format == 'binary' else 'w') as output_file:
+                count = write_results(results, args.output_format, output_file)
+        elif args.output_format == 'binary':
+            count = write_results(results, args.output_format, sys.stdout.buffer)
+        else:
+            count = write_results(results, args.output_format, sys.stdout)
+    finally:
+        set_coefficient_ring(previous_ring)
+        if isinstance(cache, PersistentProductCache):
+            cache.close()
+    elapsed = time.perf_counter() - start
+    if not args.quiet:
+        print(format_report(count, elapsed, instrumentation), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+import pytest
+from cli import main
+from functions import fourfold
+from functions_test import x1, x2, x3, x4
+from notation import parse
+from serialization import TermReader, TermWriter
+
+
+class TestMain:
+    quadruple_line = f'{x1}; {x2}; {x3}; {x4}'
+
+    def test_text_input_and_output(self, tmp_path, capsys):
+        input_path = tmp_path / 'quadruples.txt'
+        input_path.write_text(f'# inputs\n{self.quadruple_line}\n\n{self.quadruple_line}\n')
+        main([str(input_path)])
+        output, report = capsys.readouterr()
+        lines = output.splitlines()
+        assert len(lines) == 2
+        assert [str(parse(result)) for result in lines[0].split(';')] == list(map(str, fourfold(x1, x2, x3, x4)))
+        assert report.startswith('2 quadruples in')
+        assert 'cobound of x24' in report
+
+    def test_binary_input_and_output_in_process_pool(self, tmp_path, capsys):
+        input_path, output_path = tmp_path / 'quadruples.bin', tmp_path / 'results.bin'
+        with open(input_path, 'wb') as input_file:
+            writer = TermWriter(input_file)
+            for x in (x1, x2, x3, x4) * 3:
+                writer.write(x)
+        main([str(input_path), '--input-format', 'binary', '--format', 'binary', '--output', str(output_path),
+              '--jobs', '2'])
+        with open(output_path, 'rb') as output_file:
+            results = list(TermReader(output_file))
+        assert list(map(str, results)) == list(map(str, fourfold(x1, x2, x3, x4))) * 3
+        assert '3 quadruples in' in capsys.readouterr().err
+
+    @pytest.mark.parametrize('option', [['--modulus', '1'], ['--jobs', '-3'], ['--cache-size', '-1']])
+    def test_invalid_options(self, option, capsys):
+        with pytest.raises(SystemExit):
+            main(['--example', *option])
+        assert 'error:' in capsys.readouterr().err
+
+    def test_modulus(self, tmp_path, capsys):
+        input_path = tmp_path / 'quadruples.txt'
+        input_path.write_text(f'{x1}; {x2}; 2*(e^{{7}}_{{3,5,6}}); {x4}\n')
+        main([str(input_path), '--modulus', '2', '--quiet'])
+        assert capsys.readouterr().out.split('; ')[:3] == [str(fourfold(x1, x2, x3, x4)[0]), '0', '0']
+
+    def test_cache_file_is_closed(self, tmp_path, capsys):
+        cache_path = tmp_path / 'products.sqlite'
+        main(['--example', '--cache-file', str(cache_path), '--quiet'])
+        main(['--example', '--cache-file', str(cache_path), '--quiet'])
+        first_output, second_output = capsys.readouterr().out.splitlines()
+        assert first_output == second_output
+        # Closing the last connection checkpoints the write-ahead log into the database and removes it
+        assert not (tmp_path / 'products.sqlite-wal').exists()
+
+    def test_malformed_line(self, tmp_path):
+        input_path = tmp_path / 'quadruples.txt'
+        input_path.write_text(f'{x1}; {x2}; {x3}\n')
+        with pytest.raises(ValueError, match='quadruples.txt:1'):
+            main([str(input_path), '--quiet'])
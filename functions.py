@@ -1,65 +1,303 @@
-from typing import Union, Set
-from collections import Counter
+import bisect
+import contextlib
+import functools
+import hashlib
+import inspect
+import io
+import itertools
+import json
+import multiprocessing.util
+import os
+import sqlite3
+import threading
+import time
+import warnings
+import weakref
+from array import array
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Union, Set, Tuple, Optional, Iterable, Iterator
+from collections import Counter, OrderedDict, deque
+
+try:
+    import numpy
+except ImportError:  # The vectorized multiplication of elementary terms is optional
+    numpy = None
+
+
+# The bit of a number in the bitmasks is its dense id, assigned in order of first appearance,
+#   so a mask is as long as the count of distinct numbers in use rather than the largest number
+_number_ids = dict()
+_numbers_by_id = list()
+_number_ids_lock = threading.Lock()
+
+
+def number_id(number) -> int:
+    """ Dense id of a number (the position of its bit in bitmasks), assigned on first use. """
+    assigned_id = _number_ids.get(number)
+    if assigned_id is None:
+        with _number_ids_lock:
+            assigned_id = _number_ids.setdefault(number, len(_numbers_by_id))
+            if assigned_id == len(_numbers_by_id):
+                _numbers_by_id.append(number)
+    return assigned_id
+
+
+def number_bit(number) -> int:
+    """ Bit of a number in bitmasks, or 0 for a number that never appeared (and is in no mask). """
+    assigned_id = _number_ids.get(number)
+    return 1 << assigned_id if assigned_id is not None else 0
+
+
+def bitmask(numbers) -> int:
+    """ Encode a set of numbers as an integer bitmask (see number_id()). """
+    mask = 0
+    for number in numbers:
+        mask |= 1 << number_id(number)
+    return mask
+
+
+def count_bits(mask: int) -> int:
+    """ Number of elements in a bitmask-encoded set. """
+    return bin(mask).count('1')
+
+
+def is_single(mask: int) -> bool:
+    """ Check whether a bitmask-encoded set has exactly one element. """
+    return mask != 0 and mask & (mask - 1) == 0
+
+
+def lowest_number(mask: int) -> int:
+    """ Element with the lowest id of a non-empty bitmask-encoded set. """
+    return _numbers_by_id[(mask & -mask).bit_length() - 1]
+
+
+class CanonicalTerm:
+    """ Immutable, hash-consed structural form of a term.
+
+    Structurally identical terms are interned to the same object, so equality is identity
+    and the hash is computed once at construction. Subscripts and superscripts are stored
+    as sorted tuples, concatenated terms as a tuple of (already interned) canonical terms.
+    The index sets are also kept as integer bitmasks (see bitmask()), including the mask
+    of all numbers in the term and its concatenated descendants.
+    """
+    __slots__ = ('superscript', 'subscript', 'concatenated_terms', 'is_zero', '_hash',
+                 'superscript_mask', 'subscript_mask', 'numbers_mask', '__weakref__')
+    _interned = weakref.WeakValueDictionary()
+    _interning_lock = threading.Lock()
+
+    def __new__(cls, superscript: Tuple = (), subscript: Tuple = (),
+                concatenated_terms: Tuple['CanonicalTerm', ...] = (), is_zero: bool = False):
+        if is_zero:
+            key = None
+        else:
+            key = (tuple(superscript), tuple(subscript), tuple(concatenated_terms))
+        interned = cls._interned.get(key)
+        if interned is not None:
+            return interned
+        with cls._interning_lock:
+            interned = cls._interned.get(key)
+            if interned is not None:
+                return interned
+            return cls._intern(key, is_zero)
+
+    @classmethod
+    def _intern(cls, key, is_zero: bool) -> 'CanonicalTerm':
+        canonical = object.__new__(cls)
+        set_attribute = object.__setattr__
+        set_attribute(canonical, 'is_zero', is_zero)
+        set_attribute(canonical, 'superscript', key[0] if key else ())
+        set_attribute(canonical, 'subscript', key[1] if key else ())
+        set_attribute(canonical, 'concatenated_terms', key[2] if key else ())
+        set_attribute(canonical, '_hash', hash(key))
+        superscript_mask = bitmask(canonical.superscript)
+        subscript_mask = bitmask(canonical.subscript)
+        numbers_mask = superscript_mask | subscript_mask
+        for concat_term in canonical.concatenated_terms:
+            numbers_mask |= concat_term.numbers_mask
+        set_attribute(canonical, 'superscript_mask', superscript_mask)
+        set_attribute(canonical, 'subscript_mask', subscript_mask)
+        set_attribute(canonical, 'numbers_mask', numbers_mask)
+        cls._interned[key] = canonical
+        return canonical
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __hash__(self):
+        return self._hash
+
+    def __reduce__(self):
+        return CanonicalTerm, (self.superscript, self.subscript, self.concatenated_terms, self.is_zero)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __repr__(self):
+        return f'CanonicalTerm({str(self.to_term())})'
+
+    def find_path(self, number: int) -> Optional[Tuple[int, ...]]:
+        """ Child indices leading from this term to the first node (in depth-first order)
+            containing the number, or None if the number is absent. """
+        bit = number_bit(number)
+        if not self.numbers_mask & bit:
+            return None
+        path = list()
+        node = self
+        while not (node.subscript_mask | node.superscript_mask) & bit:
+            for index, concat_term in enumerate(node.concatenated_terms):
+                if concat_term.numbers_mask & bit:
+                    path.append(index)
+                    node = concat_term
+                    break
+        return tuple(path)
+
+    def with_concatenated_terms(self, concatenated_terms: Tuple['CanonicalTerm', ...]) -> 'CanonicalTerm':
+        """ The same node with its concatenated terms replaced. """
+        return CanonicalTerm(self.superscript, self.subscript, concatenated_terms)
+
+    def to_term(self) -> 'Term':
+        """ Build a fresh Term tree (with ancestor links) from the canonical form. """
+        # Terms are immutable, so every node is built after its concatenated terms, on a stack of finished terms
+        terms = list()
+        nodes = [(self, False)]
+        while nodes:
+            canonical, concatenated_terms_done = nodes.pop()
+            if canonical.is_zero:
+                terms.append(Term(is_zero=True))
+            elif not concatenated_terms_done:
+                nodes.append((canonical, True))
+                nodes.extend((concat_canonical, False) for concat_canonical in reversed(canonical.concatenated_terms))
+            else:
+                concatenated_terms_start = len(terms) - len(canonical.concatenated_terms)
+                term = Term(superscript=canonical.superscript, subscript=canonical.subscript,
+                            concatenated_terms=terms[concatenated_terms_start:])
+                term._canonical = canonical
+                del terms[concatenated_terms_start:]
+                terms.append(term)
+        return terms[0]
+
+
+class FrozenCounter(Counter):
+    """ Counter that cannot be modified, for the subscripts and superscripts of terms. """
+    def __init__(self, iterable=()):
+        # Counter.__init__() would go through the blocked update()
+        dict.__init__(self, Counter(iterable))
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError(f'{type(self).__name__} is immutable')
+
+    __setitem__ = __delitem__ = update = subtract = clear = pop = popitem = setdefault = _immutable
+    __iadd__ = __isub__ = __ior__ = __iand__ = _immutable
 
 
 class Term:
+    """ Immutable term: a tree is built from its leaves up (see build_term()), and only its caches are set later. """
+    __slots__ = ('subscript', 'superscript', 'is_zero', 'concatenated_terms', 'ancestor',
+                 '_canonical', '_number_index', '_total_numbers')
+    _CACHES = frozenset(('_canonical', '_number_index', '_total_numbers'))
+
     def __init__(self, subscript: Union[Counter, Set] = None,
                  superscript: Union[Counter, Set] = None,
                  is_zero: bool = False,
                  concatenated_terms=None,
                  ancestor=None):
-        self.subscript = Counter(subscript) if subscript is not None else Counter()
-        self.superscript = Counter(superscript) if superscript is not None else Counter()
-        self.is_zero = is_zero
-        self.concatenated_terms = concatenated_terms if concatenated_terms is not None else list()
-        self.ancestor = ancestor
-
-        if self.is_zero:
-            self.nullify()
-
-        if concatenated_terms:
-            for concat_term in concatenated_terms:
-                concat_term.ancestor = self
+        set_attribute = object.__setattr__
+        if is_zero:
+            set_attribute(self, 'subscript', None)
+            set_attribute(self, 'superscript', None)
+            set_attribute(self, 'concatenated_terms', None)
+        else:
+            set_attribute(self, 'subscript', FrozenCounter(subscript if subscript is not None else ()))
+            set_attribute(self, 'superscript', FrozenCounter(superscript if superscript is not None else ()))
+            set_attribute(self, 'concatenated_terms', tuple(concatenated_terms) if concatenated_terms else ())
+        set_attribute(self, 'is_zero', is_zero)
+        set_attribute(self, 'ancestor', ancestor)
+        set_attribute(self, '_canonical', None)
+        set_attribute(self, '_number_index', None)
+        set_attribute(self, '_total_numbers', None)
+
+        if not is_zero:
+            for concat_term in self.concatenated_terms:
+                set_attribute(concat_term, 'ancestor', self)
+
+    def __setattr__(self, name, value):
+        if name not in self._CACHES:
+            raise AttributeError(f'{type(self).__name__} is immutable')
+        object.__setattr__(self, name, value)
+
+    def __reduce__(self):
+        # The default reduction would restore the slots through the blocked __setattr__()
+        return CanonicalTerm.to_term, (self.canonical,)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return deepcopy_term(self)
 
     def __repr__(self):
-        if self.is_zero:
-            return '0'
-        else:
-            superscript_str = ''
-            subscript_str = ''
-            concatenated_terms_str = ''
-            if self.superscript:
-                superscript_str = f'superscript={{{",".join(repr(n) for n in sorted(self.superscript.elements()))}}}'
-            if self.subscript:
-                subscript_str = f'subscript={{{",".join(repr(n) for n in sorted(self.subscript.elements()))}}}'
-            if self.concatenated_terms:
-                concatenated_terms_str = \
-                    f'concatenated_terms=[{",".join([repr(term) for term in self.concatenated_terms])}]'
-            nonempty_argument_strings = \
-                [string for string in [superscript_str, subscript_str, concatenated_terms_str] if string]
-            string_repr = f'Term({", ".join(nonempty_argument_strings)})'
-        return string_repr
+        # Written out with a stack of nodes and closing strings, as chains can be deeper than the recursion limit
+        parts = list()
+        items = [self]
+        while items:
+            item = items.pop()
+            if isinstance(item, str):
+                parts.append(item)
+                continue
+            if item.is_zero:
+                parts.append('0')
+                continue
+            argument_strings = list()
+            if item.superscript:
+                argument_strings.append(
+                    f'superscript={{{",".join(repr(n) for n in sorted(item.superscript.elements()))}}}')
+            if item.subscript:
+                argument_strings.append(f'subscript={{{",".join(repr(n) for n in sorted(item.subscript.elements()))}}}')
+            if item.concatenated_terms:
+                argument_strings.append('concatenated_terms=[')
+                items.append(')')
+                items.append(']')
+                item.push_concatenated_terms(items)
+            else:
+                items.append(')')
+            parts.append(f'Term({", ".join(argument_strings)}')
+        return ''.join(parts)
 
     def __str__(self):
-        if self.is_zero:
-            return '0'
-        else:
-            superscript_str = ''
-            subscript_str = ''
-            concatenated_terms_str = ''
-            if self.superscript:
-                superscript_str = f'^{{{",".join(str(n) for n in sorted(self.superscript.elements()))}}}'
-            if self.subscript:
-                subscript_str = f'_{{{",".join(str(n) for n in sorted(self.subscript.elements()))}}}'
-            if self.concatenated_terms:
-                if len(self.concatenated_terms) == 1:
-                    concatenated_terms_str = '~' + str(self.concatenated_terms[0])
-                else:
-                    concatenated_terms_str = f'~[{",".join([str(term) for term in self.concatenated_terms])}]'
-            nonempty_argument_strings = \
-                [string for string in [superscript_str, subscript_str, concatenated_terms_str] if string]
-            string_repr = f'e{"".join(nonempty_argument_strings)}'
-        return string_repr
+        # Written out with a stack of nodes and closing strings, as chains can be deeper than the recursion limit
+        parts = list()
+        items = [self]
+        while items:
+            item = items.pop()
+            if isinstance(item, str):
+                parts.append(item)
+                continue
+            if item.is_zero:
+                parts.append('0')
+                continue
+            parts.append('e')
+            if item.superscript:
+                parts.append(f'^{{{",".join(str(n) for n in sorted(item.superscript.elements()))}}}')
+            if item.subscript:
+                parts.append(f'_{{{",".join(str(n) for n in sorted(item.subscript.elements()))}}}')
+            if len(item.concatenated_terms) == 1:
+                parts.append('~')
+                items.append(item.concatenated_terms[0])
+            elif item.concatenated_terms:
+                parts.append('~[')
+                items.append(']')
+                item.push_concatenated_terms(items)
+        return ''.join(parts)
+
+    def push_concatenated_terms(self, items: list):
+        """ Push the concatenated terms, separated by commas, on a stack of items to write out. """
+        for index in reversed(range(len(self.concatenated_terms))):
+            items.append(self.concatenated_terms[index])
+            if index:
+                items.append(',')
 
     def __mul__(self, other):
         return multiply_terms(first_term=self, second_term=other)
@@ -73,15 +311,52 @@ class Term:
     def __radd__(self, other):
         return SumOfTerms((other, self))
 
-    def __key(self):
-        return str(self)
+    @property
+    def canonical(self) -> CanonicalTerm:
+        """ Interned structural form of the term, computed once and cached. """
+        # Build the missing canonical forms bottom-up, without recursion
+        nodes = [(self, False)]
+        while nodes:
+            node, concatenated_terms_done = nodes.pop()
+            if node._canonical is not None:
+                continue
+            if node.is_zero:
+                node._canonical = CanonicalTerm(is_zero=True)
+            elif not concatenated_terms_done:
+                nodes.append((node, True))
+                nodes.extend((concat_term, False) for concat_term in node.concatenated_terms)
+            else:
+                node._canonical = CanonicalTerm(
+                    superscript=sorted(node.superscript.elements()),
+                    subscript=sorted(node.subscript.elements()),
+                    concatenated_terms=[concat_term._canonical for concat_term in node.concatenated_terms])
+        return self._canonical
+
+    @property
+    def number_index(self) -> dict:
+        """ Mapping from every number in the term and its concatenated descendants to the first node
+            (in depth-first order) containing it, built once and cached. """
+        if self._number_index is None:
+            number_index = dict()
+            nodes = [self]
+            while nodes:
+                node = nodes.pop()
+                if node.is_zero:
+                    continue
+                for number in node.subscript:
+                    number_index.setdefault(number, node)
+                for number in node.superscript:
+                    number_index.setdefault(number, node)
+                nodes.extend(reversed(node.concatenated_terms))
+            self._number_index = number_index
+        return self._number_index
 
     def __hash__(self):
-        return hash(self.__key())
+        return hash(self.canonical)
 
     def __eq__(self, other):
         if isinstance(other, Term):
-            return self.__key() == other.__key()
+            return self.canonical is other.canonical
         return NotImplemented
 
     def get_total_numbers(self, recursive=False):
@@ -89,73 +364,121 @@ class Term:
             subscript and superscript and concatenated terms. """
         if self.is_zero:
             return Counter()
-        total_numbers = self.superscript + self.subscript
-        if recursive:
-            for term in self.concatenated_terms:
-                total_numbers += term.get_total_numbers(recursive=True)
-        return total_numbers
-
-    def nullify(self):
-        """ If a term becomes zero, backtrack through its ancestor chain,
-            turn them all to zeroes as well and delete connections. """
-        self.is_zero = True
-        self.subscript = None
-        self.superscript = None
-        self.concatenated_terms = None
-        if self.ancestor is not None:
-            self.ancestor.nullify()
+        if not recursive:
+            return self.superscript + self.subscript
+        if self._total_numbers is None:
+            total_numbers = self.superscript + self.subscript
+            nodes = list(self.concatenated_terms)
+            while nodes:
+                node = nodes.pop()
+                if node.is_zero:
+                    continue
+                total_numbers.update(node.superscript)
+                total_numbers.update(node.subscript)
+                nodes.extend(node.concatenated_terms)
+            self._total_numbers = total_numbers
+        return Counter(self._total_numbers)
 
     def search_term_by_number(self, number):
         """ Search a defined number in the term and its concatenated descendants
             and return the term where it is found. """
-        if number in self.subscript or number in self.superscript:
-            return self
-        if not self.concatenated_terms:
-            return None
-        else:
-            for search_term in self.concatenated_terms:
-                search_result = search_term.search_term_by_number(number)
-                if search_result:
-                    return search_result
+        return self.number_index.get(number)
+
+
+def build_term(nodes: Iterable[Tuple[int, Iterable, Iterable]]) -> Term:
+    """ Term tree from the (parent index, subscript, superscript) of its nodes, the root first (with parent -1)
+        and every node before its concatenated terms, which keep their order. """
+    nodes = list(nodes)
+    concatenated_terms = [list() for _ in nodes]
+    for index in reversed(range(len(nodes))):
+        parent, subscript, superscript = nodes[index]
+        term = Term(subscript=subscript, superscript=superscript, concatenated_terms=concatenated_terms[index][::-1])
+        if parent < 0:
+            return term
+        concatenated_terms[parent].append(term)
 
 
 class SumOfTerms:
-    def __init__(self, terms):
-        self.terms = list()
+    """ Linear combination of terms, stored as a term -> coefficient mapping.
+        Identical terms are merged as they are added, in order of first appearance,
+        and their coefficients are reduced in the installed CoefficientRing, if any.
+        add_term(), add_items() and += change the sum in place; + returns a new sum. """
+    def __init__(self, terms=()):
+        self.coefficients = dict()
         for term in terms:
-            if isinstance(term, SumOfTerms):
-                self.terms.extend(term.terms)
+            self.add_term(term)
+
+    def add_term(self, term, coefficient: int = 1):
+        """ Add a term (or a whole sum, or a scalar multiple) with the given coefficient in place. """
+        if isinstance(term, SumOfTerms):
+            for summed_term, summed_coefficient in term.items():
+                self.add_term(summed_term, summed_coefficient * coefficient)
+        elif isinstance(term, ScalarMultiplication):
+            self.add_term(term.term, term.scalar * coefficient)
+        elif not term.is_zero and coefficient:
+            new_coefficient = self.coefficients.get(term, 0) + coefficient
+            if _coefficient_ring is not None:
+                new_coefficient = _coefficient_ring.reduce(new_coefficient)
+            if new_coefficient:
+                self.coefficients[term] = new_coefficient
             else:
-                if term.is_zero:
-                    continue
-                self.terms.append(term)
+                self.coefficients.pop(term, None)
+        return self
+
+    def add_items(self, items: Iterable[Tuple['Term', int]]) -> 'SumOfTerms':
+        """ Add (term, coefficient) pairs in place, taking them one at a time from any iterable,
+            such as the product and cobound streams of iter_products() and iter_cobound(). """
+        for term, coefficient in items:
+            self.add_term(term, coefficient)
+        return self
+
+    def items(self):
+        """ Pairs of distinct terms and their coefficients. """
+        return self.coefficients.items()
+
+    def copy(self) -> 'SumOfTerms':
+        """ New sum with the same coefficients, sharing the terms (which are never modified by the operations). """
+        copied_sum = SumOfTerms()
+        copied_sum.coefficients = dict(self.coefficients)
+        return copied_sum
+
+    @property
+    def terms(self) -> list:
+        """ Flat list of summands, with each term repeated according to its coefficient.
+            A sum with a negative coefficient has no such list, so ValueError is raised. """
+        for term, coefficient in self.coefficients.items():
+            if coefficient < 0:
+                raise ValueError(f'The term {str(term)} has the negative coefficient {coefficient}')
+        return [term for term, coefficient in self.coefficients.items() for _ in range(coefficient)]
+
+    def __len__(self):
+        return len(self.coefficients)
 
     def __repr__(self):
-        if not self.terms:
+        if not self.coefficients:
             return '0'
-        string_repr = ' + '.join(repr(term) for term in self.terms)
+        # Multiples in the notation of __str__ (parsed by notation.py), since repeating a term cannot show them all
+        string_repr = ' + '.join(repr(term) if count == 1 else repr(ScalarMultiplication(count, term))
+                                 for term, count in self.coefficients.items())
         return string_repr
 
     def __str__(self):
-        if not self.terms:
+        if not self.coefficients:
             return '0'
 
         def scalar_multiple_string(item, count):
-            if count <= 1:
+            if count == 1:
                 return str(item)
             else:
-                return f'{count}*({str(item)})'
-        term_count = Counter(self.terms)
-        string_str = ' + '.join(scalar_multiple_string(term, count) for term, count in term_count.items())
+                return repr(ScalarMultiplication(count, item))
+        string_str = ' + '.join(scalar_multiple_string(term, count) for term, count in self.coefficients.items())
         return string_str
 
     def __add__(self, other):
-        if isinstance(other, SumOfTerms):
-            self.terms.extend(other.terms)
-            return self
-        elif isinstance(other, Term) and not other.is_zero:
-            self.terms.append(other)
-            return self
+        return self.copy().add_term(other)
+
+    def __iadd__(self, other):
+        return self.add_term(other)
 
     def __mul__(self, other):
         return multiply_terms(first_term=self, second_term=other)
@@ -164,9 +487,7 @@ class SumOfTerms:
         return multiply_terms(first_term=other, second_term=self)
 
     def __eq__(self, other):
-        return isinstance(other, SumOfTerms) \
-               and len(self.terms) == len(other.terms) \
-               and all(x == y for x, y in zip(self.terms, other.terms))
+        return isinstance(other, SumOfTerms) and self.coefficients == other.coefficients
 
 
 class ScalarMultiplication:
@@ -179,96 +500,981 @@ class ScalarMultiplication:
         return string_repr
 
 
-def total(counter: Counter) -> int:
-    """ Small helper function returning the sum of counter values"""
-    return sum(counter.values())
+# The modes replaced by the with-blocks installing another one, by the name of their module global
+_replaced_modes = dict()
 
 
-def first(counter: Counter):
-    """ Small helper function returning a value from the counter"""
-    return next(iter(counter))
+def install_mode(global_name: str, mode):
+    """ Set the module global holding a mode and return its previous value. """
+    previous_mode = globals()[global_name]
+    globals()[global_name] = mode
+    return previous_mode
 
 
-def multiply_elementary_terms(first_term: Term, second_term: Term) -> Union[Term, SumOfTerms]:
-    """ Multiply two elementary (non-sum and non-concatenated) terms. """
-    if first_term.is_zero or second_term.is_zero:
-        return Term(is_zero=True)
+class GlobalMode:
+    """ Mode installed for all subsequent computations as the module global `global_name`,
+        by a (reentrant) with-block or the set_*() function of the mode. """
+    global_name = None
 
-    first_sub = first_term.subscript or Counter()
-    second_sub = second_term.subscript or Counter()
-    first_super = first_term.superscript or Counter()
-    second_super = second_term.superscript or Counter()
+    def __enter__(self):
+        _replaced_modes.setdefault(self.global_name, list()).append(install_mode(self.global_name, self))
+        return self
 
-    first_numbers = first_term.get_total_numbers(recursive=True)
-    second_numbers = second_term.get_total_numbers(recursive=True)
-    total_numbers_in_common = total(first_numbers & second_numbers)
+    def __exit__(self, exc_type, exc_value, traceback):
+        install_mode(self.global_name, _replaced_modes[self.global_name].pop())
 
-    # If terms have two or more numbers in common, return 0
-    if total_numbers_in_common > 1:
+    @property
+    def installed(self) -> bool:
+        return globals()[self.global_name] is self
+
+
+class CoefficientRing(GlobalMode):
+    """ Ring of the coefficients of sums (the integers, or the integers modulo `modulus`),
+        by which SumOfTerms.add_term() reduces the coefficients while it is installed. """
+    global_name = '_coefficient_ring'
+
+    def __init__(self, modulus: Optional[int] = None):
+        if modulus is not None and modulus < 2:
+            raise ValueError(f'The modulus must be at least 2, not {modulus}')
+        self.modulus = modulus
+
+    def __repr__(self):
+        return 'CoefficientRing()' if self.modulus is None else f'CoefficientRing({self.modulus})'
+
+    def reduce(self, coefficient: int) -> int:
+        return coefficient % self.modulus if self.modulus is not None else coefficient
+
+
+_coefficient_ring: Optional[CoefficientRing] = None
+
+
+def set_coefficient_ring(ring: Optional[CoefficientRing]) -> Optional[CoefficientRing]:
+    """ Install the coefficient ring for all subsequent sums (None means the integers).
+        Return the previously installed ring. """
+    return install_mode('_coefficient_ring', ring)
+
+
+def numbers_in(mask: int) -> list:
+    """ Sorted elements of a bitmask-encoded set. """
+    numbers = list()
+    while mask:
+        lowest_bit = mask & -mask
+        numbers.append(_numbers_by_id[lowest_bit.bit_length() - 1])
+        mask ^= lowest_bit
+    return sorted(numbers)
+
+
+class FlatTerm:
+    """ Compact array-backed form of a term tree.
+
+    The nodes are stored in depth-first (pre-)order: the `parents` array holds the index of the parent
+    of every node (-1 for the root), and the `numbers` array the ids (see number_id()) of the subscript
+    and then of the superscript of every node, each index set sorted and ending at the next offset
+    of the `bounds` array (node i has its subscript in numbers[bounds[2i]:bounds[2i + 1]]
+    and its superscript in numbers[bounds[2i + 1]:bounds[2i + 2]]).
+    The concatenated terms of a node are the nodes whose parent it is, in index order.
+    All algorithms are iterative, so deep chains are not limited by the recursion limit.
+    """
+    __slots__ = ('parents', 'numbers', 'bounds', 'is_zero')
+
+    def __init__(self, parents=(), numbers=(), bounds=(0,), is_zero: bool = False):
+        self.parents = array('l', parents)
+        self.numbers = array('q', numbers)
+        self.bounds = array('q', bounds)
+        self.is_zero = is_zero
+
+    def __len__(self):
+        return len(self.parents)
+
+    def __eq__(self, other):
+        if isinstance(other, FlatTerm):
+            return self.is_zero == other.is_zero and self.parents == other.parents \
+                   and self.numbers == other.numbers and self.bounds == other.bounds
+        return NotImplemented
+
+    def __repr__(self):
+        return f'FlatTerm({str(self.to_term())})'
+
+    @classmethod
+    def from_term(cls, term: Term) -> 'FlatTerm':
+        if term.is_zero:
+            return cls(is_zero=True)
+        flat_term = cls()
+        nodes = [(term, -1)]
+        while nodes:
+            node, parent = nodes.pop()
+            flat_term.append_node(parent, sorted(map(number_id, node.subscript)),
+                                  sorted(map(number_id, node.superscript)))
+            nodes.extend((concat_term, len(flat_term) - 1) for concat_term in reversed(node.concatenated_terms))
+        return flat_term
+
+    @classmethod
+    def from_canonical(cls, canonical: CanonicalTerm) -> 'FlatTerm':
+        if canonical.is_zero:
+            return cls(is_zero=True)
+        flat_term = cls()
+        nodes = [(canonical, -1)]
+        while nodes:
+            node, parent = nodes.pop()
+            flat_term.append_node(parent, sorted(map(number_id, node.subscript)),
+                                  sorted(map(number_id, node.superscript)))
+            nodes.extend((concat_term, len(flat_term) - 1) for concat_term in reversed(node.concatenated_terms))
+        return flat_term
+
+    def append_node(self, parent: int, subscript_ids, superscript_ids):
+        """ Add a node, given the sorted ids of its numbers, as the last concatenated term of the parent
+            (which must be the last node or one of its ancestors, to keep the depth-first order). """
+        self.parents.append(parent)
+        self.numbers.extend(subscript_ids)
+        self.bounds.append(len(self.numbers))
+        self.numbers.extend(superscript_ids)
+        self.bounds.append(len(self.numbers))
+
+    def subscript_ids(self, index: int) -> array:
+        return self.numbers[self.bounds[2 * index]:self.bounds[2 * index + 1]]
+
+    def superscript_ids(self, index: int) -> array:
+        return self.numbers[self.bounds[2 * index + 1]:self.bounds[2 * index + 2]]
+
+    def subscript(self, index: int) -> list:
+        return sorted(_numbers_by_id[assigned_id] for assigned_id in self.subscript_ids(index))
+
+    def superscript(self, index: int) -> list:
+        return sorted(_numbers_by_id[assigned_id] for assigned_id in self.superscript_ids(index))
+
+    def to_term(self) -> Term:
+        """ Build the Term tree, with ancestor links. """
+        if self.is_zero:
+            return Term(is_zero=True)
+        return build_term((parent, self.subscript(index), self.superscript(index))
+                          for index, parent in enumerate(self.parents))
+
+    def to_canonical(self) -> CanonicalTerm:
+        if self.is_zero:
+            return CanonicalTerm(is_zero=True)
+        # Children always come after their parents, so build the canonical forms from the last node backwards
+        concatenated_terms = [list() for _ in self.parents]
+        for index in reversed(range(len(self.parents))):
+            canonical = CanonicalTerm(superscript=self.superscript(index), subscript=self.subscript(index),
+                                      concatenated_terms=reversed(concatenated_terms[index]))
+            if self.parents[index] < 0:
+                return canonical
+            concatenated_terms[self.parents[index]].append(canonical)
+
+    def copy(self) -> 'FlatTerm':
+        return FlatTerm(self.parents, self.numbers, self.bounds, self.is_zero)
+
+    def nullify(self):
+        """ Turn the whole term into zero. """
+        self.is_zero = True
+        self.parents = array('l')
+        self.numbers = array('q')
+        self.bounds = array('q', (0,))
+
+    def numbers_mask(self) -> int:
+        """ Bitmask of all numbers in the term and its concatenated descendants. """
+        mask = 0
+        for assigned_id in self.numbers:
+            mask |= 1 << assigned_id
+        return mask
+
+    def search_node_by_number(self, number) -> Optional[int]:
+        """ Index of the first node (in depth-first order) containing the number, or None. """
+        assigned_id = _number_ids.get(number)
+        if assigned_id is None:
+            return None
+        try:
+            position = self.numbers.index(assigned_id)
+        except ValueError:
+            return None
+        return (bisect.bisect_right(self.bounds, position) - 1) // 2
+
+    def concatenated_term_indices(self) -> list:
+        """ List of the concatenated term indices of every node. """
+        concatenated_terms = [list() for _ in self.parents]
+        for index, parent in enumerate(self.parents):
+            if parent >= 0:
+                concatenated_terms[parent].append(index)
+        return concatenated_terms
+
+    def reroot(self, index: int) -> 'FlatTerm':
+        """ Copy of the tree with the node as its root: like reverse_tree(), every ancestor of the node
+            becomes the last concatenated term of the node below it. """
+        if self.is_zero:
+            return self.copy()
+        concatenated_terms = self.concatenated_term_indices()
+        node = index
+        while self.parents[node] >= 0:
+            above_node = self.parents[node]
+            concatenated_terms[above_node].remove(node)
+            concatenated_terms[node].append(above_node)
+            node = above_node
+        rerooted_term = FlatTerm()
+        nodes = [(index, -1)]
+        while nodes:
+            node, parent = nodes.pop()
+            rerooted_term.append_node(parent, self.subscript_ids(node), self.superscript_ids(node))
+            nodes.extend((concat_node, len(rerooted_term) - 1) for concat_node in reversed(concatenated_terms[node]))
+        return rerooted_term
+
+
+class NoCommonNumbersWarning(UserWarning):
+    """ Two terms without any numbers in common were multiplied (the product is zero). """
+
+
+class Instrumentation(GlobalMode):
+    """ Rule hits, zero reasons, timings of n-fold entries and cobounds, and warnings of the computations
+        while it is installed. """
+    global_name = '_instrumentation'
+
+    def __init__(self, max_warnings: int = 100):
+        self.rule_hits = Counter()
+        self.zero_reasons = Counter()
+        self.timings = dict()
+        self.warnings = list()
+        self.warning_count = 0
+        self.max_warnings = max_warnings
+        # The computations of a thread pool record concurrently
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def record_rule(self, rule: Optional[str], count: int = 1):
+        with self._lock:
+            self.rule_hits[rule] += count
+            if rule in ZERO_RULES:
+                self.zero_reasons[rule] += count
+
+    def record_zero(self, reason: str, count: int = 1):
+        if count:
+            with self._lock:
+                self.zero_reasons[reason] += count
+
+    def record_timing(self, key, seconds: float):
+        with self._lock:
+            timing = self.timings.setdefault(key, [0.0, 0])
+            timing[0] += seconds
+            timing[1] += 1
+
+    def record_warning(self, message_factory):
+        """ Count a warning, and keep its message (built by calling message_factory) while below the limit. """
+        with self._lock:
+            self.warning_count += 1
+            keep_message = len(self.warnings) < self.max_warnings
+            if keep_message:
+                self.warnings.append(None)
+                message_index = len(self.warnings) - 1
+        if keep_message:
+            self.warnings[message_index] = message_factory()
+
+    def merge(self, other: 'Instrumentation'):
+        """ Add the counts, timings and warnings of another instrumentation (e.g. from a worker process). """
+        with self._lock:
+            self.rule_hits.update(other.rule_hits)
+            self.zero_reasons.update(other.zero_reasons)
+            for key, (seconds, calls) in other.timings.items():
+                timing = self.timings.setdefault(key, [0.0, 0])
+                timing[0] += seconds
+                timing[1] += calls
+            self.warnings.extend(other.warnings[:max(0, self.max_warnings - len(self.warnings))])
+            self.warning_count += other.warning_count
+
+    def report(self) -> dict:
+        return {
+            'rule_hits': dict(self.rule_hits),
+            'zero_reasons': dict(self.zero_reasons),
+            'timings': {key: {'seconds': seconds, 'calls': calls} for key, (seconds, calls) in self.timings.items()},
+            'warning_count': self.warning_count,
+        }
+
+
+_instrumentation: Optional[Instrumentation] = None
+
+
+def set_instrumentation(instrumentation: Optional[Instrumentation]) -> Optional[Instrumentation]:
+    """ Install instrumentation for all subsequent computations (None disables it).
+        Return the previously installed instrumentation. """
+    return install_mode('_instrumentation', instrumentation)
+
+
+def warn_no_common_numbers(first_term: Term, second_term: Term):
+    """ Report a product of terms without numbers in common: collect it in the installed instrumentation,
+        or emit a NoCommonNumbersWarning at the first caller outside this module, which the warnings module
+        shows once per call site and pair of terms by default. """
+    instrumentation = _instrumentation
+    if instrumentation is not None:
+        instrumentation.record_zero('no_numbers_in_common')
+        instrumentation.record_warning(
+            lambda: f'Warning: zero numbers in common between {str(first_term)} and {str(second_term)}')
+        return
+    # Skip the frames of this module (products, the product cache and the streams), however many there are
+    stacklevel = 1
+    frame = inspect.currentframe()
+    while frame is not None and frame.f_code.co_filename == __file__:
+        frame = frame.f_back
+        stacklevel += 1
+    warnings.warn(f'Zero numbers in common between {str(first_term)} and {str(second_term)}',
+                  NoCommonNumbersWarning, stacklevel=stacklevel)
+
+
+class ProductCache(GlobalMode):
+    """ Bounded LRU cache of frozen term products and cobounds, keyed on the canonical forms of the operands. """
+    global_name = '_product_cache'
+
+    def __init__(self, maxsize: int = 65536):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """ Return the frozen product stored under the key (marking it as recently used), or None. """
+        with self._lock:
+            frozen_product = self._entries.get(key)
+            if frozen_product is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return frozen_product
+
+    def put(self, key, frozen_product):
+        """ Store a frozen product, evicting the least recently used entries above maxsize. """
+        with self._lock:
+            self._entries[key] = frozen_product
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+_product_cache: Optional[ProductCache] = None
+
+
+def set_product_cache(cache: Optional[ProductCache]) -> Optional[ProductCache]:
+    """ Install a product cache for all subsequent multiplications (None disables caching).
+        Return the previously installed cache. """
+    return install_mode('_product_cache', cache)
+
+
+class ElementaryTable(GlobalMode):
+    """ Rules of the products and ids of the cobounds of the elementary terms over the numbers 1, ..., universe,
+        stored on first use (sparsely) or by precompute(), and used while the table is installed. """
+    global_name = '_elementary_table'
+    FORMAT_VERSION = 3
+    UNKNOWN = -2
+    NOT_APPLICABLE = -1
+    PRECOMPUTE_BLOCK_SIZE = 256
+
+    def __init__(self, universe: int = 16, max_subscript: int = 3, max_superscript: int = 1):
+        if not 0 < universe < 63:
+            raise ValueError('The universe must be between 1 and 62 numbers')
+        self.universe = universe
+        self.max_subscript = max_subscript
+        self.max_superscript = max_superscript
+        self.subscripts = list()
+        self.superscripts = list()
+        numbers = range(1, universe + 1)
+        for subscript_size in range(max_subscript + 1):
+            for subscript in itertools.combinations(numbers, subscript_size):
+                remaining_numbers = [number for number in numbers if number not in subscript]
+                for superscript_size in range(max_superscript + 1):
+                    for superscript in itertools.combinations(remaining_numbers, superscript_size):
+                        self.subscripts.append(subscript)
+                        self.superscripts.append(superscript)
+        self.term_ids = {index_sets: term_id
+                         for term_id, index_sets in enumerate(zip(self.subscripts, self.superscripts))}
+        self.cobounds = array('q', [self.UNKNOWN]) * len(self.term_ids)
+        self.rules = dict()
+
+    def __len__(self):
+        return len(self.term_ids)
+
+    def term_id(self, term: Union[Term, CanonicalTerm]) -> Optional[int]:
+        """ Id of the term's own subscript and superscript, or None if they are outside the table. """
+        canonical = term.canonical if isinstance(term, Term) else term
+        return self.term_ids.get((canonical.subscript, canonical.superscript))
+
+    def term(self, term_id: int) -> Term:
+        return Term(subscript=self.subscripts[term_id], superscript=self.superscripts[term_id])
+
+    def canonical(self, term_id: int) -> CanonicalTerm:
+        return CanonicalTerm(superscript=self.superscripts[term_id], subscript=self.subscripts[term_id])
+
+    def rule_code(self, rule: Optional[str]) -> int:
+        return ELEMENTARY_RULES.index(rule) if rule is not None else self.NOT_APPLICABLE
+
+    def multiply(self, first_term: Term, second_term: Term) -> Optional[Union[Term, SumOfTerms]]:
+        """ Product of two non-zero elementary terms from the table, or None if either is outside it
+            or if no rule applies to them. """
+        first_id = self.term_id(first_term)
+        second_id = self.term_id(second_term)
+        if first_id is None or second_id is None:
+            return None
+        pair_index = first_id * len(self.term_ids) + second_id
+        try:
+            rule_code = self.rules[pair_index]
+        except KeyError:
+            rule_code = self.UNKNOWN
+        if rule_code == self.UNKNOWN:
+            # From the nodes of the ids alone, as the rule is stored under them
+            rule_code = self.rule_code(select_elementary_rule(self.canonical(first_id), self.canonical(second_id)))
+            self.rules[pair_index] = rule_code
+        if rule_code == self.NOT_APPLICABLE:
+            return None
+        return build_elementary_product(ELEMENTARY_RULES[rule_code], first_term, second_term)
+
+    def cobound(self, term: CanonicalTerm) -> Optional[CanonicalTerm]:
+        """ Cobound of a non-zero node without superscript from the table, keeping its concatenated terms,
+            or None if it is outside the table. """
+        term_id = self.term_id(term)
+        if term_id is None:
+            return None
+        cobound_id = self.cobounds[term_id]
+        if cobound_id == self.UNKNOWN:
+            cobound_id = self.compute_cobound(term_id)
+        if cobound_id == self.NOT_APPLICABLE:
+            return None
+        return CanonicalTerm(superscript=self.superscripts[cobound_id], subscript=self.subscripts[cobound_id],
+                             concatenated_terms=term.concatenated_terms)
+
+    def compute_cobound(self, term_id: int) -> int:
+        """ Look up the id of the cobound of an elementary term (the largest subscript number moved
+            to the superscript) and store it. """
+        subscript = self.subscripts[term_id]
+        cobound_id = self.NOT_APPLICABLE
+        if subscript and not self.superscripts[term_id]:
+            cobound_id = self.term_ids.get((subscript[:-1], subscript[-1:]), self.NOT_APPLICABLE)
+        self.cobounds[term_id] = cobound_id
+        return cobound_id
+
+    def precompute(self):
+        """ Compute all cobounds and the rules of all pairs of terms. With numpy, the rules are classified
+            a block of first terms at a time (see classify_elementary_pairs()); without it, only the pairs
+            sharing a number are computed, and the others on first use if ever needed. """
+        for term_id in range(len(self.term_ids)):
+            if self.cobounds[term_id] == self.UNKNOWN:
+                self.compute_cobound(term_id)
+        if isinstance(self.rules, dict):
+            rules = array('b', [self.UNKNOWN]) * (len(self.term_ids) * len(self.term_ids))
+            for pair_index, rule_code in self.rules.items():
+                rules[pair_index] = rule_code
+            self.rules = rules
+        terms = [self.term(term_id) for term_id in range(len(self.term_ids))]
+        if numpy is not None:
+            columns = {number: number - 1 for number in range(1, self.universe + 1)}
+            for block_start in range(0, len(terms), self.PRECOMPUTE_BLOCK_SIZE):
+                block = terms[block_start:block_start + self.PRECOMPUTE_BLOCK_SIZE]
+                _, rules = classify_elementary_pairs(block, terms, columns)
+                self.rules[block_start * len(terms):(block_start + len(block)) * len(terms)] = \
+                    array('b', rules.astype(numpy.int8).tobytes())
+            return
+        term_ids_by_number = [list() for _ in range(self.universe + 1)]
+        for term_id, (subscript, superscript) in enumerate(zip(self.subscripts, self.superscripts)):
+            for number in subscript + superscript:
+                term_ids_by_number[number].append(term_id)
+        for first_id, first_term in enumerate(terms):
+            pair_start = first_id * len(terms)
+            first_numbers = self.subscripts[first_id] + self.superscripts[first_id]
+            for second_id in {second_id for number in first_numbers for second_id in term_ids_by_number[number]}:
+                if self.rules[pair_start + second_id] == self.UNKNOWN:
+                    self.rules[pair_start + second_id] = self.rule_code(
+                        select_elementary_rule(first_term.canonical, terms[second_id].canonical))
+
+    def save(self, path):
+        """ Save the computed results, to be loaded back with load(). The file has a line of JSON describing
+            the table, followed by the raw cobounds array and either the dense rules array or the pair ids
+            and rules of the sparse ones. """
+        dense = not isinstance(self.rules, dict)
+        header = {
+            'version': self.FORMAT_VERSION,
+            'rules_version': rules_version(),
+            'universe': self.universe,
+            'max_subscript': self.max_subscript,
+            'max_superscript': self.max_superscript,
+            'dense': dense,
+            'rule_count': len(self.rules),
+        }
+        with open(path, 'wb') as table_file:
+            table_file.write(json.dumps(header).encode() + b'\n')
+            self.cobounds.tofile(table_file)
+            if dense:
+                self.rules.tofile(table_file)
+            else:
+                array('q', self.rules.keys()).tofile(table_file)
+                array('b', self.rules.values()).tofile(table_file)
+
+    @classmethod
+    def load(cls, path) -> 'ElementaryTable':
+        """ Load a table saved with save(). The results saved by another version of the rules are dropped. """
+        with open(path, 'rb') as table_file:
+            header = json.loads(table_file.readline())
+            if header.get('version') != cls.FORMAT_VERSION:
+                raise ValueError(f'Unsupported elementary table version: {header.get("version")}')
+            table = cls(header['universe'], header['max_subscript'], header['max_superscript'])
+            if header['rules_version'] != rules_version():
+                return table
+            cobounds = array('q')
+            cobounds.fromfile(table_file, len(table))
+            rules = array('b')
+            if header['dense']:
+                rules.fromfile(table_file, header['rule_count'])
+            else:
+                pair_indexes = array('q')
+                pair_indexes.fromfile(table_file, header['rule_count'])
+                rules.fromfile(table_file, header['rule_count'])
+                rules = dict(zip(pair_indexes, rules))
+        table.cobounds = cobounds
+        table.rules = rules
+        return table
+
+
+_elementary_table: Optional[ElementaryTable] = None
+
+
+def set_elementary_table(table: Optional[ElementaryTable]) -> Optional[ElementaryTable]:
+    """ Install an elementary table for all subsequent products and cobounds (None disables it).
+        Return the previously installed table. """
+    return install_mode('_elementary_table', table)
+
+
+def canonical_key(canonical: CanonicalTerm) -> str:
+    """ Stable text encoding of a canonical term: the parent index and the subscript and superscript numbers
+        of every node, in the depth-first order of FlatTerm. """
+    if canonical.is_zero:
+        return '0'
+    node_keys = list()
+    nodes = [(canonical, -1)]
+    while nodes:
+        node, parent = nodes.pop()
+        node_keys.append(f'{parent}:{",".join(map(str, node.subscript))}:{",".join(map(str, node.superscript))}')
+        nodes.extend((concat_term, len(node_keys) - 1) for concat_term in reversed(node.concatenated_terms))
+    return ';'.join(node_keys)
+
+
+def rules_version() -> str:
+    """ Digest of the source of the functions defining products and cobounds, which changes with the rules. """
+    source = ''.join(inspect.getsource(function) for function in (
+        select_elementary_rule, build_elementary_product, multiply_single_terms, merge_canonical_chains,
+        cobound_canonical, cobound_elementary_node))
+    return hashlib.sha256(source.encode()).hexdigest()[:16]
+
+
+class PersistentProductCache(GlobalMode):
+    """ ProductCache in an sqlite database shared across runs and worker processes, and cleared
+        when it was filled by another rules_version(). """
+    global_name = '_product_cache'
+    FORMAT_VERSION = 3
+    TOUCH_BATCH_SIZE = 256
+    EVICTION_INTERVAL = 1024
+
+    def __init__(self, path, maxsize: int = 1000000, version: Optional[str] = None, timeout: float = 60.0):
+        self.path = str(path)
+        self.maxsize = maxsize
+        self.version = version or rules_version()
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._connections = threading.local()
+        self._open_connections = list()
+        self._touched_keys = list()
+        self._puts_since_eviction = 0
+        self._lock = threading.Lock()
+        self.check_version()
+
+    def __getstate__(self):
+        return {'path': self.path, 'maxsize': self.maxsize, 'version': self.version, 'timeout': self.timeout}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        super().__exit__(exc_type, exc_value, traceback)
+        if not self.installed:
+            self.close()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """ Connection of the current thread in the current process, opened on first use. """
+        connections = self._connections
+        if getattr(connections, 'pid', None) != os.getpid():
+            # Only used by its own thread, but close() closes the connections of all threads
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS products '
+                               '(key TEXT PRIMARY KEY, product BLOB NOT NULL, last_used REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS products_last_used ON products (last_used)')
+            connection.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            connections.connection = connection
+            connections.pid = os.getpid()
+            with self._lock:
+                self._open_connections.append((connections.pid, connection))
+        return connections.connection
+
+    def check_version(self):
+        """ Drop all entries if the database was filled by another version of the rules. """
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            stored_versions = dict(connection.execute("SELECT name, value FROM metadata "
+                                                      "WHERE name IN ('version', 'format')").fetchall())
+            versions = {'version': self.version, 'format': str(self.FORMAT_VERSION)}
+            if stored_versions != versions:
+                connection.execute('DELETE FROM products')
+                connection.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?)', versions.items())
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    @staticmethod
+    def encode_key(key) -> str:
+        return '|'.join(part if isinstance(part, str) else canonical_key(part) for part in key)
+
+    @staticmethod
+    def encode_product(frozen_product) -> bytes:
+        """ Serialized sum of the terms of a frozen product (the encoder takes canonical terms as well). """
+        import serialization  # Imports this module
+        stream = io.BytesIO()
+        serialization.TermWriter(stream).write_items(frozen_product)
+        return stream.getvalue()
+
+    @staticmethod
+    def decode_product(data: bytes) -> Tuple[Tuple[CanonicalTerm, int], ...]:
+        """ Frozen product back from encode_product(), with its coefficients as stored. """
+        import serialization  # Imports this module
+        return tuple((term.canonical, coefficient)
+                     for term, coefficient in serialization.TermReader(data).read_items())
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM products').fetchone()[0]
+
+    def get(self, key):
+        """ Return the frozen product stored under the key, or None. """
+        encoded_key = self.encode_key(key)
+        row = self.connection.execute('SELECT product FROM products WHERE key = ?', (encoded_key,)).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touched_keys.append(encoded_key)
+            touched_keys = self.take_touched_keys(self.TOUCH_BATCH_SIZE)
+        if touched_keys:
+            self.touch(touched_keys)
+        return self.decode_product(row[0])
+
+    def put(self, key, frozen_product):
+        """ Store a frozen product, evicting the least recently used entries above maxsize now and then. """
+        self.connection.execute('INSERT OR REPLACE INTO products VALUES (?, ?, ?)',
+                                (self.encode_key(key), self.encode_product(frozen_product), time.time()))
+        with self._lock:
+            self._puts_since_eviction += 1
+            evict = self._puts_since_eviction >= self.EVICTION_INTERVAL
+            if evict:
+                self._puts_since_eviction = 0
+        if evict:
+            self.evict()
+
+    def take_touched_keys(self, batch_size: int) -> list:
+        if len(self._touched_keys) < batch_size:
+            return []
+        touched_keys, self._touched_keys = self._touched_keys, list()
+        return touched_keys
+
+    def touch(self, encoded_keys: list):
+        """ Mark entries as used now. """
+        now = time.time()
+        self.connection.executemany('UPDATE products SET last_used = ? WHERE key = ?',
+                                    [(now, encoded_key) for encoded_key in encoded_keys])
+
+    def flush(self):
+        """ Write the pending usage times. """
+        with self._lock:
+            touched_keys = self.take_touched_keys(1)
+        if touched_keys:
+            self.touch(touched_keys)
+
+    def evict(self):
+        """ Delete the least recently used entries above maxsize. """
+        self.flush()
+        excess = len(self) - self.maxsize
+        if excess > 0:
+            self.connection.execute('DELETE FROM products WHERE key IN '
+                                    '(SELECT key FROM products ORDER BY last_used LIMIT ?)', (excess,))
+
+    def clear(self):
+        self.connection.execute('DELETE FROM products')
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        """ Write the pending usage times and evict, then close the connections of every thread of this process
+            (the ones inherited from a parent process are left alone). """
+        pid = os.getpid()
+        if any(connection_pid == pid for connection_pid, _ in self._open_connections):
+            self.evict()
+        with self._lock:
+            open_connections, self._open_connections = self._open_connections, list()
+            self._connections = threading.local()
+        for connection_pid, connection in open_connections:
+            if connection_pid == pid:
+                connection.close()
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self), 'maxsize': self.maxsize,
+                'version': self.version}
+
+
+def freeze_product(product: Union[Term, SumOfTerms]) -> Tuple[Tuple[CanonicalTerm, int], ...]:
+    """ Immutable form of a multiplication result: pairs of canonical terms and their coefficients. """
+    if isinstance(product, SumOfTerms):
+        return tuple((term.canonical, coefficient) for term, coefficient in product.items())
+    if product.is_zero:
+        return tuple()
+    return ((product.canonical, 1),)
+
+
+def thaw_product(frozen_product: Tuple[Tuple[CanonicalTerm, int], ...]) -> Union[Term, SumOfTerms]:
+    """ Build fresh Term trees back from the output of freeze_product(). """
+    if not frozen_product:
         return Term(is_zero=True)
+    if len(frozen_product) == 1 and frozen_product[0][1] == 1:
+        return frozen_product[0][0].to_term()
+    thawed_sum = SumOfTerms()
+    for canonical, coefficient in frozen_product:
+        thawed_sum.add_term(canonical.to_term(), coefficient)
+    return thawed_sum
+
+
+def cached_product(multiply):
+    """ Decorator routing a product of two terms through the installed ProductCache, if there is one. """
+    @functools.wraps(multiply)
+    def cached_multiply(first_term: Term, second_term: Term) -> Union[Term, SumOfTerms]:
+        cache = _product_cache
+        if cache is None:
+            return multiply(first_term, second_term)
+        key = (multiply.__name__, first_term.canonical, second_term.canonical)
+        frozen_product = cache.get(key)
+        if frozen_product is None:
+            frozen_product = freeze_product(multiply(first_term, second_term))
+            cache.put(key, frozen_product)
+        return thaw_product(frozen_product)
+    return cached_multiply
+
+
+# The rules of multiply_elementary_terms(), in the order they are checked in
+ELEMENTARY_RULES = ('two_or_more_numbers_in_common', 'subscripts_coincide', 'second_subscript_in_first_subscript',
+                    'first_subscript_in_second_subscript', 'first_superscript_in_second_subscript',
+                    'second_superscript_in_first_subscript', 'equal_superscripts')
+ZERO_RULES = ('two_or_more_numbers_in_common', 'subscripts_coincide')
+
+
+def select_elementary_rule(first_term: CanonicalTerm, second_term: CanonicalTerm) -> Optional[str]:
+    """ Name of the multiply_elementary_terms() rule applying to two non-zero terms, or None if none does.
+        The rules are selected on the bitmask-encoded index sets of the canonical forms. """
+    first_sub_mask = first_term.subscript_mask
+    second_sub_mask = second_term.subscript_mask
+    first_super_mask = first_term.superscript_mask
+    second_super_mask = second_term.superscript_mask
+
+    # If terms have two or more numbers in common, return 0
+    if count_bits(first_term.numbers_mask & second_term.numbers_mask) > 1:
+        return 'two_or_more_numbers_in_common'
 
     # If both subscripts are longer than 1 and coincide in at least one number, return 0
-    if total(first_sub) > 1 and total(second_sub) > 1 and total(first_sub & second_sub) > 0:
-        return Term(is_zero=True)
+    if not is_single(first_sub_mask) and not is_single(second_sub_mask) and first_sub_mask & second_sub_mask:
+        return 'subscripts_coincide'
 
     # If second subscript is a single number that is present in the first subscript,
     #   extend first superscript with the second superscript
-    if total(second_sub) == 1 and total(first_sub) >= 1 and first(second_sub) in first_sub:
-        return Term(subscript=first_sub, superscript=(first_super + second_super))
+    if is_single(second_sub_mask) and second_sub_mask & first_sub_mask:
+        return 'second_subscript_in_first_subscript'
 
     # If first subscript is a single number that is present in the second subscript,
     #   extend second superscript with the first superscript
-    if total(first_sub) == 1 and total(second_sub) >= 1 and first(first_sub) in second_sub:
+    if is_single(first_sub_mask) and first_sub_mask & second_sub_mask:
+        return 'first_subscript_in_second_subscript'
+
+    if is_single(first_super_mask) and first_super_mask & second_sub_mask:
+        return 'first_superscript_in_second_subscript'
+
+    if is_single(second_super_mask) and second_super_mask & first_sub_mask:
+        return 'second_superscript_in_first_subscript'
+
+    if is_single(first_super_mask) and first_super_mask == second_super_mask:
+        return 'equal_superscripts'
+
+    return None
+
+
+def build_elementary_product(rule: str, first_term: Term, second_term: Term) -> Union[Term, SumOfTerms]:
+    """ Product of two elementary terms by the given multiply_elementary_terms() rule. """
+    first_sub = first_term.subscript or Counter()
+    second_sub = second_term.subscript or Counter()
+    first_super = first_term.superscript or Counter()
+    second_super = second_term.superscript or Counter()
+
+    if rule in ZERO_RULES:
+        return Term(is_zero=True)
+
+    if rule == 'second_subscript_in_first_subscript':
+        return Term(subscript=first_sub, superscript=(first_super + second_super))
+
+    if rule == 'first_subscript_in_second_subscript':
         return Term(subscript=second_sub, superscript=(second_super + first_super))
 
-    if total(first_super) == 1 and first(first_super) in second_sub:
-        main_term = Term(subscript=first_sub)
-        concatenated_term = Term(superscript=second_super, subscript=second_sub, ancestor=main_term)
-        main_term.concatenated_terms.append(concatenated_term)
-        return main_term
-
-    if total(second_super) == 1 and first(second_super) in first_sub:
-        main_term = Term(superscript=first_super, subscript=first_sub)
-        concatenated_term = Term(subscript=second_sub, ancestor=main_term)
-        main_term.concatenated_terms.append(concatenated_term)
-        return main_term
-
-    if len(first_super) == 1 and first_super == second_super:
-        first_main_term = Term(superscript=first_super, subscript=first_sub)
-        first_concatenated_term = Term(subscript=second_sub, ancestor=first_main_term)
-        first_main_term.concatenated_terms.append(first_concatenated_term)
-        second_main_term = Term(subscript=first_sub)
-        second_concatenated_term = Term(superscript=first_super, subscript=second_sub, ancestor=second_main_term)
-        second_main_term.concatenated_terms.append(second_concatenated_term)
+    if rule == 'first_superscript_in_second_subscript':
+        return Term(subscript=first_sub, concatenated_terms=[Term(superscript=second_super, subscript=second_sub)])
+
+    if rule == 'second_superscript_in_first_subscript':
+        return Term(superscript=first_super, subscript=first_sub, concatenated_terms=[Term(subscript=second_sub)])
+
+    if rule == 'equal_superscripts':
+        first_main_term = Term(superscript=first_super, subscript=first_sub,
+                               concatenated_terms=[Term(subscript=second_sub)])
+        second_main_term = Term(subscript=first_sub,
+                                concatenated_terms=[Term(superscript=first_super, subscript=second_sub)])
         return SumOfTerms((first_main_term, second_main_term))
 
+    raise ValueError(f'Unknown multiplication rule: {rule}')
+
+
+@cached_product
+def multiply_elementary_terms(first_term: Term, second_term: Term) -> Union[Term, SumOfTerms]:
+    """ Multiply two elementary (non-sum and non-concatenated) terms. """
+    if first_term.is_zero or second_term.is_zero:
+        if _instrumentation is not None:
+            _instrumentation.record_zero('zero_factor')
+        return Term(is_zero=True)
+
+    table = _elementary_table
+    if table is not None:
+        product = table.multiply(first_term, second_term)
+        if product is not None:
+            return product
+    return compute_elementary_product(first_term, second_term)
+
+
+def compute_elementary_product(first_term: Term, second_term: Term) -> Union[Term, SumOfTerms]:
+    """ Product of two non-zero elementary terms by the rule that applies to them. """
+    rule = select_elementary_rule(first_term.canonical, second_term.canonical)
+    if _instrumentation is not None:
+        _instrumentation.record_rule(rule)
+
+    if rule is not None:
+        return build_elementary_product(rule, first_term, second_term)
+
     # The options above cover every defined path in the pdf, so if we reached this point, something went wrong
     raise ValueError(f'Error while multiplying terms: {str(first_term)} and {str(second_term)}')
 
 
-def reverse_tree(root_node: Term) -> Term:
-    above_node = root_node.ancestor
-    if above_node:
-        above_node.concatenated_terms.remove(root_node)
-        root_node.concatenated_terms.append(above_node)
-        reverse_tree(root_node=above_node)
-        above_node.ancestor = root_node
-    return root_node
+def reverse_tree(node: Term) -> Term:
+    """ Copy of the node's tree with the node as its root: every ancestor becomes the last concatenated term
+        of the node below it. """
+    # Terms are immutable, so the reversed chain of ancestors is rebuilt on canonical forms, from the old root down
+    path = list()
+    while node.ancestor is not None:
+        above_node = node.ancestor
+        path.append((above_node, next(index for index, concat_term in enumerate(above_node.concatenated_terms)
+                                      if concat_term is node)))
+        node = above_node
+    reversed_ancestors = None
+    for above_node, child_index in reversed(path):
+        concatenated_terms = above_node.canonical.concatenated_terms
+        concatenated_terms = concatenated_terms[:child_index] + concatenated_terms[child_index + 1:]
+        if reversed_ancestors is not None:
+            concatenated_terms += (reversed_ancestors,)
+        reversed_ancestors = above_node.canonical.with_concatenated_terms(concatenated_terms)
+        node = above_node.concatenated_terms[child_index]
+    if reversed_ancestors is None:
+        return node.canonical.to_term()
+    return node.canonical.with_concatenated_terms(node.canonical.concatenated_terms + (reversed_ancestors,)).to_term()
 
 
 def deepcopy_term(original_term: Term) -> Term:
-    """ Have to have my own implementation of deepcopy because copy.deepcopy() makes wrong ancestor links. """
-    new_term = Term(
-        is_zero=original_term.is_zero,
-        subscript=original_term.subscript,
-        superscript=original_term.superscript,
-        ancestor=original_term.ancestor
-    )
-    for concatenated_term in original_term.concatenated_terms:
-        copied_concatenated_term = deepcopy_term(concatenated_term)
-        copied_concatenated_term.ancestor = new_term
-        new_term.concatenated_terms.append(copied_concatenated_term)
-    return new_term
+    """ Fresh copy of the term's tree, detached from the ancestors of the term. """
+    return original_term.canonical.to_term()
+
+
+def merge_canonical_chains(first_term: CanonicalTerm, second_term: CanonicalTerm,
+                           multiplication_product: CanonicalTerm, common_number: int) -> CanonicalTerm:
+    """ Persistent implementation of merge_concatenation_chains() on canonical terms.
+
+    Ancestors are addressed by child index paths from the roots (see CanonicalTerm.find_path()),
+    so only the nodes on the paths to the multiplied nodes are rebuilt,
+    and every other subtree of both inputs is shared with the result.
+    """
+    first_path = first_term.find_path(common_number)
+    second_path = second_term.find_path(common_number)
+    first_ancestors = [first_term]
+    for index in first_path:
+        first_ancestors.append(first_ancestors[-1].concatenated_terms[index])
+    first_node = first_ancestors.pop()
+    second_ancestors = [second_term]
+    for index in second_path:
+        second_ancestors.append(second_ancestors[-1].concatenated_terms[index])
+    second_node = second_ancestors.pop()
+
+    # Reverse the ancestor chain of the second node: every ancestor loses the child on the path
+    # and gets its own (already reversed) ancestor appended as the last child
+    reversed_second_ancestors = None
+    for ancestor, index in zip(second_ancestors, second_path):
+        concatenated_terms = ancestor.concatenated_terms[:index] + ancestor.concatenated_terms[index + 1:]
+        if reversed_second_ancestors is not None:
+            concatenated_terms += (reversed_second_ancestors,)
+        reversed_second_ancestors = ancestor.with_concatenated_terms(concatenated_terms)
+    second_term_extension = second_node.concatenated_terms
+    if reversed_second_ancestors is not None:
+        second_term_extension += (reversed_second_ancestors,)
+
+    # In case elementary multiplication returns not just a single term, but an already concatenated node X1~X2,
+    # we want to attach the rest of the second tree to the node X2, not X1
+    if multiplication_product.concatenated_terms:
+        extended_node = multiplication_product.concatenated_terms[0]
+        extended_node = extended_node.with_concatenated_terms(extended_node.concatenated_terms
+                                                              + second_term_extension)
+        product_node = multiplication_product.with_concatenated_terms(
+            (extended_node,) + multiplication_product.concatenated_terms[1:] + first_node.concatenated_terms)
+    elif reversed_second_ancestors is not None:
+        product_node = multiplication_product.with_concatenated_terms(
+            second_term_extension + first_node.concatenated_terms)
+    else:
+        product_node = multiplication_product.with_concatenated_terms(
+            first_node.concatenated_terms + second_term_extension)
+
+    # Put the product node in place of the first node: it becomes the last child of the first node's ancestor,
+    # and the ancestors above are rebuilt with the new child in the same position
+    merged_term = product_node
+    if first_ancestors:
+        ancestor = first_ancestors.pop()
+        index = first_path[-1]
+        merged_term = ancestor.with_concatenated_terms(
+            ancestor.concatenated_terms[:index] + ancestor.concatenated_terms[index + 1:] + (merged_term,))
+        for ancestor, index in zip(reversed(first_ancestors), reversed(first_path[:-1])):
+            merged_term = ancestor.with_concatenated_terms(
+                ancestor.concatenated_terms[:index] + (merged_term,) + ancestor.concatenated_terms[index + 1:])
+    return merged_term
 
 
 def merge_concatenation_chains(first_term: Term, second_term: Term,
@@ -281,54 +1487,30 @@ def merge_concatenation_chains(first_term: Term, second_term: Term,
     1) Replace B with the multiplication product B'~K': A~B'~K'~C
     2) Merge the ancestor chain of K in reverse order: A~B'~K'~[C, J~I]
     3) Merge the descendant nodes of K: A~B'~K'~[C, J~I, L]
-    """
-
-    copied_product_node = deepcopy_term(multiplication_product)
-    copied_first_term = deepcopy_term(first_term)
-    copied_second_term = deepcopy_term(second_term)
-    copied_first_node = copied_first_term.search_term_by_number(common_number)
-    copied_second_node = copied_second_term.search_term_by_number(common_number)
 
-    # In case elementary multiplication returns not just a single term, but an already concatenated node X1~X2,
-    # we want to attach the rest of the tree to the node X2, not X1
-    second_term_extension_point = copied_product_node.concatenated_terms
-    if copied_product_node.concatenated_terms:
-        second_term_extension_point = copied_product_node.concatenated_terms[0].concatenated_terms
-
-    if copied_second_node.ancestor:
-        reversed_second_ancestor_tree = reverse_tree(copied_second_node)
-        second_term_extension_point.extend(reversed_second_ancestor_tree.concatenated_terms)
-
-    if copied_first_node.concatenated_terms:
-        copied_product_node.concatenated_terms.extend(copied_first_node.concatenated_terms)
-    if copied_second_node.concatenated_terms:
-        second_term_extension_point.extend(copied_second_node.concatenated_terms)
-
-    if copied_first_node.ancestor:
-        ancestor = copied_first_node.ancestor
-        ancestor.concatenated_terms.append(copied_product_node)
-        ancestor.concatenated_terms.remove(copied_first_node)
-        while copied_first_node.ancestor:
-            copied_first_node = copied_first_node.ancestor
-        copied_first_term = copied_first_node
-    else:
-        copied_first_term = copied_product_node
-    return copied_first_term
+    The inputs are left untouched; see merge_canonical_chains() for the implementation.
+    """
+    return merge_canonical_chains(first_term=first_term.canonical,
+                                  second_term=second_term.canonical,
+                                  multiplication_product=multiplication_product.canonical,
+                                  common_number=common_number).to_term()
 
 
+@cached_product
 def multiply_single_terms(first_term: Term, second_term: Term) -> Union[Term, SumOfTerms]:
     """ Multiply single terms that may have concatenated elements."""
-    first_numbers = first_term.get_total_numbers(recursive=True)
-    second_numbers = second_term.get_total_numbers(recursive=True)
-    total_numbers_in_common = total(first_numbers & second_numbers)
+    numbers_in_common = first_term.canonical.numbers_mask & second_term.canonical.numbers_mask
+    total_numbers_in_common = count_bits(numbers_in_common)
 
     # If terms have two or more numbers in common, return 0
     if total_numbers_in_common > 1:
+        if _instrumentation is not None:
+            _instrumentation.record_zero('two_or_more_numbers_in_common')
         return Term(is_zero=True)
 
     # If no numbers in common, return 0 and show a warning
     if total_numbers_in_common == 0:
-        print(f'Warning: zero numbers in common between {str(first_term)} and {str(second_term)}')
+        warn_no_common_numbers(first_term, second_term)
         return Term(is_zero=True)
 
     if not first_term.concatenated_terms and not second_term.concatenated_terms:
@@ -337,7 +1519,7 @@ def multiply_single_terms(first_term: Term, second_term: Term) -> Union[Term, Su
     # Find the nodes in first and second trees that have a number in common,
     # replace that node in the first tree with the multiplication product of those nodes
     # then attach the rest of the second tree to that node, relative to its position in the second tree
-    common_number = first(first_numbers & second_numbers)
+    common_number = lowest_number(numbers_in_common)
     first_term_multiplication_node = first_term.search_term_by_number(common_number)
     second_term_multiplication_node = second_term.search_term_by_number(common_number)
     node_multiplication_product = multiply_elementary_terms(first_term_multiplication_node,
@@ -347,22 +1529,315 @@ def multiply_single_terms(first_term: Term, second_term: Term) -> Union[Term, Su
     else:
         multiplication_products = [node_multiplication_product]
 
+    # The chains are merged on the canonical forms, sharing the untouched subtrees,
+    # and the Term trees are only built once for the final result
     overall_multiplication_products = list()
     for product_node in multiplication_products:
         if not product_node or product_node.is_zero:
             continue
-        merged_term = merge_concatenation_chains(first_term=first_term,
-                                                 second_term=second_term,
-                                                 multiplication_product=product_node,
-                                                 common_number=common_number)
-        overall_multiplication_products.append(merged_term)
-
-    if len(overall_multiplication_products) == 0:
-        return Term(is_zero=True)
-    if len(overall_multiplication_products) == 1:
-        return overall_multiplication_products[0]
+        merged_term = merge_canonical_chains(first_term=first_term.canonical,
+                                             second_term=second_term.canonical,
+                                             multiplication_product=product_node.canonical,
+                                             common_number=common_number)
+        overall_multiplication_products.append((merged_term, 1))
+    return thaw_product(tuple(overall_multiplication_products))
+
+
+def iter_items(value) -> Iterator[Tuple[Term, int]]:
+    """ (term, coefficient) pairs of a Term (with coefficient 1), of a SumOfTerms, or of an iterable of such pairs,
+        which is passed through. """
+    if isinstance(value, SumOfTerms):
+        return iter(value.items())
+    if isinstance(value, Term):
+        return iter(((value, 1),))
+    return iter(value)
+
+
+def iter_scaled_items(value, coefficient: int) -> Iterator[Tuple[Term, int]]:
+    """ (term, coefficient) pairs of a Term or SumOfTerms multiplied by a coefficient. """
+    for term, term_coefficient in iter_items(value):
+        yield term, term_coefficient * coefficient
+
+
+def iter_term_pair_products(first_terms, second_terms) -> Iterator[Tuple[Term, int]]:
+    """ Lazily multiply every pair from two sequences of (term, coefficient) pairs, yielding the summands
+        of the products in order. The first terms are taken one at a time, so they may come from a stream.
+        Only the pairs sharing exactly one number can have a nonzero product, so they are found
+        through an index from every number to the second terms containing it, and the other pairs are skipped. """
+    second_terms = list(second_terms)
+    second_terms_by_number = dict()
+    for index, (term, _) in enumerate(second_terms):
+        for number in numbers_in(term.canonical.numbers_mask):
+            second_terms_by_number.setdefault(number, []).append(index)
+
+    instrumentation = _instrumentation
+    for i, i_coefficient in first_terms:
+        # Number of shared numbers with every second term sharing any
+        numbers_in_common = Counter()
+        for number in numbers_in(i.canonical.numbers_mask):
+            numbers_in_common.update(second_terms_by_number.get(number, ()))
+        candidates = sorted(index for index, count in numbers_in_common.items() if count == 1)
+        for index in candidates:
+            j, j_coefficient = second_terms[index]
+            yield from iter_scaled_items(i * j, i_coefficient * j_coefficient)
+        if instrumentation is not None:
+            instrumentation.record_zero('two_or_more_numbers_in_common', len(numbers_in_common) - len(candidates))
+            instrumentation.record_zero('no_numbers_in_common', len(second_terms) - len(numbers_in_common))
+
+
+def multiply_term_pairs(first_terms, second_terms) -> SumOfTerms:
+    """ Multiply every pair from two sequences of (term, coefficient) pairs and sum the products. """
+    return SumOfTerms().add_items(iter_term_pair_products(first_terms, second_terms))
+
+
+VECTORIZED_THRESHOLD = 4096
+VECTORIZED_BLOCK_SIZE = 256
+VECTORIZED_CANDIDATE_BLOCK_SIZE = 4096
+
+
+def index_set_matrix(index_sets, columns: dict):
+    """ 0/1 matrix with a row per index set and a column per number (only the numbers in `columns` count). """
+    matrix = numpy.zeros((len(index_sets), len(columns)), dtype=numpy.float32)
+    rows, row_columns = list(), list()
+    for row, index_set in enumerate(index_sets):
+        for number in index_set:
+            column = columns.get(number)
+            if column is not None:
+                rows.append(row)
+                row_columns.append(column)
+    matrix[rows, row_columns] = 1
+    return matrix
+
+
+def classify_elementary_pairs(first_terms: list, second_terms: list, columns: dict):
+    """ Numbers in common and multiply_elementary_terms() rule (an index of ELEMENTARY_RULES, or -1 if none
+        applies) of every pair of the elementary terms, as matrices. The columns must cover all numbers
+        of the first terms, and the overlaps come from products of the 0/1 index set matrices. """
+    first_sub = index_set_matrix([term.subscript for term in first_terms], columns)
+    first_super = index_set_matrix([term.superscript for term in first_terms], columns)
+    second_sub = index_set_matrix([term.subscript for term in second_terms], columns)
+    second_super = index_set_matrix([term.superscript for term in second_terms], columns)
+
+    numbers_in_common = numpy.maximum(first_sub, first_super) @ numpy.maximum(second_sub, second_super).T
+    subscripts_in_common = first_sub @ second_sub.T
+    first_super_in_second_sub = first_super @ second_sub.T
+    second_super_in_first_sub = first_sub @ second_super.T
+    superscripts_in_common = first_super @ second_super.T
+
+    first_single_sub = numpy.array([[len(term.subscript) == 1] for term in first_terms])
+    first_single_super = numpy.array([[len(term.superscript) == 1] for term in first_terms])
+    second_single_sub = numpy.array([[len(term.subscript) == 1 for term in second_terms]])
+    second_single_super = numpy.array([[len(term.superscript) == 1 for term in second_terms]])
+
+    # The conditions of select_elementary_rule(), in the order of ELEMENTARY_RULES
+    rules = numpy.select([
+        numbers_in_common > 1,
+        ~first_single_sub & ~second_single_sub & (subscripts_in_common > 0),
+        second_single_sub & (subscripts_in_common > 0),
+        first_single_sub & (subscripts_in_common > 0),
+        first_single_super & (first_super_in_second_sub > 0),
+        second_single_super & (second_super_in_first_sub > 0),
+        first_single_super & second_single_super & (superscripts_in_common > 0),
+    ], range(len(ELEMENTARY_RULES)), default=-1)
+    return numbers_in_common, rules
+
+
+def iter_elementary_term_pair_products(first_terms, second_terms) -> Iterator[Tuple[Term, int]]:
+    """ Vectorized iter_term_pair_products() for sequences of (term, coefficient) pairs of elementary terms.
+
+    The first terms are taken in blocks, each against the second terms sharing a number with it
+    (found through a number index, as in iter_term_pair_products()). The rules of all pairs of a block are selected
+    at once by classify_elementary_pairs(), and only the nonzero products are built, in the serial order.
+    Requires numpy. The products bypass the ProductCache.
+    """
+    first_terms = iter(first_terms)
+    second_terms = list(second_terms)
+    second_terms_by_number = dict()
+    for index, (term, _) in enumerate(second_terms):
+        for number in term.subscript.keys() | term.superscript.keys():
+            second_terms_by_number.setdefault(number, []).append(index)
+
+    instrumentation = _instrumentation
+    while True:
+        block = list(itertools.islice(first_terms, VECTORIZED_BLOCK_SIZE))
+        if not block:
+            return
+        block_terms = [term for term, _ in block]
+        columns = dict()
+        for term in block_terms:
+            for number in term.subscript.keys() | term.superscript.keys():
+                columns.setdefault(number, len(columns))
+        candidates = sorted({index for number in columns for index in second_terms_by_number.get(number, ())})
+
+        pairs = list()
+        pair_count = 0
+        for candidate_start in range(0, len(candidates), VECTORIZED_CANDIDATE_BLOCK_SIZE):
+            candidate_block = candidates[candidate_start:candidate_start + VECTORIZED_CANDIDATE_BLOCK_SIZE]
+            numbers_in_common, rules = classify_elementary_pairs(
+                block_terms, [second_terms[index][0] for index in candidate_block], columns)
+            rows, candidate_columns = numpy.nonzero(numbers_in_common)
+            pair_rules = rules[rows, candidate_columns]
+            pair_count += len(rows)
+            if (pair_rules < 0).any():
+                row, column = rows[pair_rules < 0][0], candidate_columns[pair_rules < 0][0]
+                raise ValueError(f'Error while multiplying terms: {str(block_terms[row])} '
+                                 f'and {str(second_terms[candidate_block[column]][0])}')
+            if instrumentation is not None:
+                rule_counts = numpy.bincount(pair_rules, minlength=len(ELEMENTARY_RULES)).tolist()
+                # As in multiply_term_pairs(), pairs with two or more numbers in common never reach the rules
+                instrumentation.record_zero(ELEMENTARY_RULES[0], rule_counts[0])
+                for rule, count in enumerate(rule_counts[1:], 1):
+                    if count:
+                        instrumentation.record_rule(ELEMENTARY_RULES[rule], count)
+            nonzero = ~numpy.isin(pair_rules, [ELEMENTARY_RULES.index(rule) for rule in ZERO_RULES])
+            pairs.extend(zip(rows[nonzero].tolist(),
+                             [candidate_block[column] for column in candidate_columns[nonzero].tolist()],
+                             pair_rules[nonzero].tolist()))
+        if instrumentation is not None:
+            instrumentation.record_zero('no_numbers_in_common', len(block) * len(second_terms) - pair_count)
+
+        # Candidate blocks follow each other in the order of the second terms, so sorting restores the pair order
+        for row, index, rule in sorted(pairs):
+            first_term, first_coefficient = block[row]
+            second_term, second_coefficient = second_terms[index]
+            yield from iter_scaled_items(build_elementary_product(ELEMENTARY_RULES[rule], first_term, second_term),
+                                         first_coefficient * second_coefficient)
+
+
+def multiply_elementary_term_pairs(first_terms, second_terms) -> SumOfTerms:
+    """ Vectorized multiply_term_pairs(), see iter_elementary_term_pair_products(). """
+    return SumOfTerms().add_items(iter_elementary_term_pair_products(first_terms, second_terms))
+
+
+def multiply_frozen_term_pairs(first_frozen_terms, second_frozen_terms, modulus: Optional[int] = None,
+                               shared_cache: Optional['PersistentProductCache'] = None):
+    """ Process pool task: multiply_term_pairs() on frozen (picklable) operands, returning a frozen product.
+        The coefficients are reduced in the coefficient ring of the given modulus, and the products
+        go through the given persistent cache, as in the calling process. """
+    first_terms = [(canonical.to_term(), coefficient) for canonical, coefficient in first_frozen_terms]
+    second_terms = [(canonical.to_term(), coefficient) for canonical, coefficient in second_frozen_terms]
+    with CoefficientRing(modulus), shared_cache if shared_cache is not None else contextlib.nullcontext():
+        return freeze_product(multiply_term_pairs(first_terms, second_terms))
+
+
+def multiply_frozen_term_pairs_instrumented(first_frozen_terms, second_frozen_terms, modulus: Optional[int] = None,
+                                            shared_cache: Optional['PersistentProductCache'] = None):
+    """ Process pool task: multiply_frozen_term_pairs() under a fresh Instrumentation, returned along with
+        the product. """
+    with Instrumentation() as instrumentation:
+        frozen_product = multiply_frozen_term_pairs(first_frozen_terms, second_frozen_terms, modulus, shared_cache)
+    return frozen_product, instrumentation
+
+
+def frozen_term_pairs_task(first_frozen_terms, second_frozen_terms) -> tuple:
+    """ Process pool task multiplying frozen operands, followed by its arguments, in the installed modes
+        that carry over to worker processes: the coefficient ring, the Instrumentation (merged back by
+        collect_frozen_term_pairs()) and a PersistentProductCache. An in-memory ProductCache
+        and an ElementaryTable stay in the calling process. """
+    task = multiply_frozen_term_pairs if _instrumentation is None else multiply_frozen_term_pairs_instrumented
+    shared_cache = _product_cache if isinstance(_product_cache, PersistentProductCache) else None
+    return task, first_frozen_terms, second_frozen_terms, current_modulus(), shared_cache
+
+
+def collect_frozen_term_pairs(frozen_result):
+    """ Frozen product of a frozen_term_pairs_task(), merging its instrumentation into the installed one. """
+    if _instrumentation is None:
+        return frozen_result
+    frozen_product, worker_instrumentation = frozen_result
+    _instrumentation.merge(worker_instrumentation)
+    return frozen_product
+
+
+def current_modulus() -> Optional[int]:
+    """ Modulus of the installed coefficient ring, to be passed on to worker processes. """
+    return _coefficient_ring.modulus if _coefficient_ring is not None else None
+
+
+class ParallelMultiplication(GlobalMode):
+    """ Process pool settings for large sum x sum products in multiply_terms(). """
+    global_name = '_parallel_multiplication'
+
+    def __init__(self, max_workers: Optional[int] = None, threshold: int = 2000, chunks_per_worker: int = 4):
+        self.max_workers = max_workers
+        self.threshold = threshold
+        self.chunks_per_worker = chunks_per_worker
+        self._executor = None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        super().__exit__(exc_type, exc_value, traceback)
+        if not self.installed:
+            self.close()
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    def close(self):
+        """ Shut down the worker processes, if they were started. """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def iter_products(self, first_terms, second_terms) -> Iterator[Tuple[Term, int]]:
+        """ Parallel equivalent of iter_term_pair_products(), yielding the summands of every chunk
+            in the same order as soon as the chunk is done. """
+        first_frozen_terms = [(term.canonical, coefficient) for term, coefficient in first_terms]
+        second_frozen_terms = [(term.canonical, coefficient) for term, coefficient in second_terms]
+        chunk_count = (self.max_workers or os.cpu_count() or 1) * self.chunks_per_worker
+        chunk_size = max(1, -(-len(first_frozen_terms) // chunk_count))
+        futures = [self.executor.submit(*frozen_term_pairs_task(first_frozen_terms[start:start + chunk_size],
+                                                                second_frozen_terms))
+                   for start in range(0, len(first_frozen_terms), chunk_size)]
+        for future in futures:
+            for canonical, coefficient in collect_frozen_term_pairs(future.result()):
+                yield canonical.to_term(), coefficient
+
+    def multiply(self, first_terms, second_terms) -> SumOfTerms:
+        """ Parallel equivalent of multiply_term_pairs(). """
+        return SumOfTerms().add_items(self.iter_products(first_terms, second_terms))
+
+
+_parallel_multiplication: Optional[ParallelMultiplication] = None
+
+
+def set_parallel_multiplication(settings: Optional[ParallelMultiplication]) -> Optional[ParallelMultiplication]:
+    """ Install process pool settings for sum x sum products (None makes them serial).
+        Return the previously installed settings. """
+    return install_mode('_parallel_multiplication', settings)
+
+
+def iter_products(first_term, second_term) -> Iterator[Tuple[Term, int]]:
+    """ Lazily yield the (term, coefficient) pairs of the product of two operands, each a Term, a SumOfTerms
+        or an iterable of (term, coefficient) pairs, such as another product stream.
+
+    The summands are produced one pair of input terms at a time, into any consumer: SumOfTerms.add_items(),
+    TermWriter.write_items(), iter_cobound() or the first operand of another iter_products().
+    The first operand is consumed as it is read, the second is read in full, since it is indexed by number.
+    Neither is modified. Equal summands are not merged and zero terms may appear; accumulating consumers skip them.
+    The vectorized and parallel paths of multiply_terms() are only taken for products of two sums.
+    """
+    if isinstance(first_term, Term) and isinstance(second_term, Term):
+        yield from iter_items(multiply_single_terms(first_term, second_term))
+        return
+
+    second_terms = list(iter_items(second_term))
+    if isinstance(first_term, (Term, SumOfTerms)):
+        first_count = len(first_term) if isinstance(first_term, SumOfTerms) else 1
+        pair_count = first_count * len(second_terms)
+    else:
+        pair_count = None
+    parallel_settings = _parallel_multiplication
+    if numpy is not None and pair_count is not None and pair_count >= VECTORIZED_THRESHOLD \
+            and isinstance(first_term, SumOfTerms) and isinstance(second_term, SumOfTerms) \
+            and not any(term.concatenated_terms for term in first_term.coefficients) \
+            and not any(term.concatenated_terms for term, _ in second_terms):
+        yield from iter_elementary_term_pair_products(first_term.items(), second_terms)
+    elif parallel_settings is not None and pair_count is not None and pair_count >= parallel_settings.threshold:
+        yield from parallel_settings.iter_products(list(iter_items(first_term)), second_terms)
     else:
-        return SumOfTerms(terms=overall_multiplication_products)
+        yield from iter_term_pair_products(iter_items(first_term), second_terms)
 
 
 def multiply_terms(first_term: Union[Term, SumOfTerms], second_term: Union[Term, SumOfTerms]) -> \
@@ -370,112 +1845,434 @@ def multiply_terms(first_term: Union[Term, SumOfTerms], second_term: Union[Term,
     """ Multiply simple and complex terms and their sums (the most general function)."""
     if not isinstance(first_term, SumOfTerms) and not isinstance(second_term, SumOfTerms):
         return multiply_single_terms(first_term, second_term)
+    return collapse_sum(SumOfTerms().add_items(iter_products(first_term, second_term)))
 
-    if isinstance(first_term, SumOfTerms):
-        first_terms = first_term.terms
-    else:
-        first_terms = [first_term]
-    if isinstance(second_term, SumOfTerms):
-        second_terms = second_term.terms
-    else:
-        second_terms = [second_term]
-
-    multiplication_products = list()
-    for i in first_terms:
-        for j in second_terms:
-            product = i * j
-            if isinstance(product, SumOfTerms):
-                multiplication_products.extend(product.terms)
-            elif isinstance(product, Term) and not product.is_zero:
-                multiplication_products.append(product)
-
-    if not multiplication_products:
+
+def collapse_sum(terms: SumOfTerms) -> Union[Term, SumOfTerms]:
+    """ The zero term for an empty sum, the term itself for a sum of one term with coefficient 1, else the sum. """
+    if not terms:
         return Term(is_zero=True)
-    elif len(multiplication_products) == 1:
-        return multiplication_products[0]
+    elif len(terms) == 1 and next(iter(terms.items()))[1] == 1:
+        return next(iter(terms.items()))[0]
     else:
-        return SumOfTerms(multiplication_products)
+        return terms
+
+
+def cobound_elementary_node(term: CanonicalTerm) -> CanonicalTerm:
+    """ Cobound of a node without superscript: its largest subscript number moves to the superscript,
+        and its concatenated terms are kept. """
+    if term.is_zero:
+        return term
+    table = _elementary_table
+    if table is not None:
+        cobound_result = table.cobound(term)
+        if cobound_result is not None:
+            return cobound_result
+    if not term.subscript:
+        raise ValueError(f'No elements applicable for cobound fuction found in term {term.to_term()}')
+    return CanonicalTerm(superscript=term.subscript[-1:], subscript=term.subscript[:-1],
+                         concatenated_terms=term.concatenated_terms)
+
+
+def cobound_canonical(term: CanonicalTerm) -> CanonicalTerm:
+    """ Apply cobound function to a single term in canonical form. The function applies to the first node
+        without superscript, which every node with a superscript above it must lead to through its only
+        concatenated term. The nodes on that path are rebuilt, and the rest of the term is shared. """
+    path = list()
+    node = term
+    while node.superscript:
+        if not node.concatenated_terms:
+            raise ValueError(f'No elements applicable for cobound fuction found in term {node.to_term()}')
+        if len(node.concatenated_terms) > 1:
+            raise ValueError(f'Multiple cobound-applicable elements found in term {node.to_term()}')
+        path.append(node)
+        node = node.concatenated_terms[0]
+    cobound_result = cobound_elementary_node(node)
+    if cobound_result.is_zero:
+        return cobound_result
+    for ancestor in reversed(path):
+        cobound_result = ancestor.with_concatenated_terms((cobound_result,))
+    return cobound_result
 
 
 def cobound_elementary_term(term: Term):
-    """ Apply cobound function to a single elementary term. """
+    """ Apply cobound function to a single elementary term, returning a new term
+        (None if the term has a superscript). """
     if term.is_zero:
         return Term(is_zero=True)
-    elif not term.superscript:
-        max_subscript = Counter([max(term.subscript.elements())])
-        subscript_without_max = term.subscript - max_subscript
-        cobound_result = Term(superscript=max_subscript,
-                              subscript=subscript_without_max,
-                              concatenated_terms=term.concatenated_terms)
-        if cobound_result.concatenated_terms:
-            for concat_term in cobound_result.concatenated_terms:
-                concat_term.ancestor = cobound_result
-        return cobound_result
-    else:
-        # raise ValueError(f'Error while trying to apply cobound function to term: {str(term)}')
+    if term.superscript:
         return None
+    return cobound_elementary_node(term.canonical).to_term()
 
 
 def cobound(term: Union[Term, SumOfTerms]):
+    """ Apply cobound function to a term or to every term of a sum, returning a new term or sum.
+        If a product cache is installed, the cobound of a term is looked up in it (keyed on its canonical form). """
     if isinstance(term, SumOfTerms):
-        return SumOfTerms(terms=[cobound(summed_term) for summed_term in term.terms])
-
-    if not term.superscript:
-        return cobound_elementary_term(term)
-
-    cobound_counter = 0  # ensure that the function is applied only once
-    if term.concatenated_terms:
-        for index, concat_term in enumerate(term.concatenated_terms):
-            cobound_result = cobound(concat_term)
-            if cobound_result:
-                term.concatenated_terms[index] = cobound_result
-                cobound_result.ancestor = term
-                cobound_counter += 1
-    if cobound_counter == 0:
-        raise ValueError(f'No elements applicable for cobound fuction found in term {term}')
-    if cobound_counter > 1:
-        raise ValueError(f'Multiple cobound-applicable elements found in term {term}')
-    return term
+        return SumOfTerms().add_items(iter_cobound(term.items()))
+
+    cache = _product_cache
+    if cache is None:
+        return cobound_single_term(term)
+    key = ('cobound', term.canonical)
+    frozen_cobound = cache.get(key)
+    if frozen_cobound is None:
+        frozen_cobound = freeze_product(cobound_single_term(term))
+        cache.put(key, frozen_cobound)
+    return thaw_product(frozen_cobound)
+
+
+def cobound_single_term(term: Term) -> Term:
+    """ Apply cobound function to a single term, returning a new term. The term itself is not changed. """
+    return cobound_canonical(term.canonical).to_term()
+
+
+def iter_cobound(items, timing_key=None) -> Iterator[Tuple[Term, int]]:
+    """ Lazily yield the cobounds of the summands of a Term, a SumOfTerms or a stream of (term, coefficient) pairs,
+        with their coefficients. Cobound is linear, so a stream of products can be cobounded before it is summed.
+        With a timing key and an installed Instrumentation, the time spent in cobound() (and only there)
+        is recorded under the key once the stream is exhausted. """
+    instrumentation = _instrumentation if timing_key is not None else None
+    if instrumentation is None:
+        for term, coefficient in iter_items(items):
+            if not term.is_zero and coefficient:
+                yield cobound(term), coefficient
+        return
+    elapsed = 0.0
+    for term, coefficient in iter_items(items):
+        if not term.is_zero and coefficient:
+            start = time.perf_counter()
+            cobound_result = cobound(term)
+            elapsed += time.perf_counter() - start
+            yield cobound_result, coefficient
+    instrumentation.record_timing(timing_key, elapsed)
+
+
+class NFoldProduct:
+    """ Lazily evaluated n-fold product of the inputs x_1, ..., x_n (indices are 1-based).
+
+    The entries follow the recurrence generalising fourfold():
+        x_ii = x_i,
+        x_ij = cobound(x_ii * x_(i+1)j + x_i(i+1) * x_(i+2)j + ... + x_i(j-1) * x_jj) for (i, j) != (1, n),
+        x_1n = the same sum without the cobound.
+    An entry is computed on first access, by dynamic programming over the length of the index interval,
+    building only the entries inside that interval. Each entry is computed once and then reused.
+    """
+    def __init__(self, *inputs: Union[Term, SumOfTerms]):
+        if len(inputs) < 2:
+            raise ValueError('An n-fold product needs at least two inputs')
+        self.n = len(inputs)
+        self.entries = {(i, i): x for i, x in enumerate(inputs, start=1)}
+
+    def __getitem__(self, index: Tuple[int, int]) -> Union[Term, SumOfTerms]:
+        i, j = index
+        if not 1 <= i <= j <= self.n:
+            raise IndexError(f'No entry x_{i}{j} in a {self.n}-fold product')
+        if index not in self.entries:
+            for length in range(1, j - i + 1):
+                for start in range(i, j - length + 1):
+                    if (start, start + length) not in self.entries:
+                        self.entries[start, start + length] = self.compute_entry(start, start + length)
+        return self.entries[index]
+
+    def compute_entry(self, i: int, j: int) -> Union[Term, SumOfTerms]:
+        """ Compute x_ij from the already known entries of the shorter intervals inside (i, j). """
+        instrumentation = _instrumentation
+        start = time.perf_counter() if instrumentation is not None else None
+        entry = self.combine_entry(i, j, [iter_products(self.entries[i, k], self.entries[k + 1, j])
+                                          for k in range(i, j)])
+        if instrumentation is not None:
+            instrumentation.record_timing(('entry', i, j), time.perf_counter() - start)
+        return entry
+
+    def combine_entry(self, i: int, j: int, products: list) -> Union[Term, SumOfTerms]:
+        """ Build x_ij from the products x_ik * x_(k+1)j, listed in order of k, each a Term, a SumOfTerms
+            or a stream of (term, coefficient) pairs (see iter_products()). The summands are cobounded
+            as they are read, so only the accumulated entry is held in memory. """
+        summands = itertools.chain.from_iterable(map(iter_items, products))
+        if (i, j) != (1, self.n):
+            summands = iter_cobound(summands, timing_key=('cobound', i, j))
+        return self.accumulate_entry(summands, products)
+
+    @staticmethod
+    def accumulate_entry(summands: Iterable[Tuple[Term, int]], products: list) -> Union[Term, SumOfTerms]:
+        # As with multiply_terms(), an entry made of a single product is a single term when it can be
+        entry = SumOfTerms().add_items(summands)
+        return collapse_sum(entry) if len(products) == 1 else entry
+
+
+def term_coefficients(value: Union[Term, SumOfTerms]) -> dict:
+    """ The term -> coefficient mapping of a Term or SumOfTerms, without copying a sum. """
+    if isinstance(value, SumOfTerms):
+        return value.coefficients
+    return {} if value.is_zero else {value: 1}
+
+
+class NumberIndex:
+    """ Index from every number to the terms of a sum containing it, updated along with the sum,
+        so that a few terms can be multiplied with the sum without reading all of it. """
+    def __init__(self, value: Union[Term, SumOfTerms]):
+        self.terms_by_number = dict()
+        for term in term_coefficients(value):
+            self.add(term)
+
+    def add(self, term: Term):
+        for number in numbers_in(term.canonical.numbers_mask):
+            self.terms_by_number.setdefault(number, dict())[term] = None
+
+    def remove(self, term: Term):
+        for number in numbers_in(term.canonical.numbers_mask):
+            terms = self.terms_by_number[number]
+            del terms[term]
+            if not terms:
+                del self.terms_by_number[number]
+
+    def iter_products(self, terms: Union[Term, SumOfTerms], value: Union[Term, SumOfTerms],
+                      indexed_first: bool) -> Iterator[Tuple[Term, int]]:
+        """ Like iter_products() of the terms with the indexed value (as the first operand if indexed_first),
+            only reading the indexed terms sharing exactly one number with each of the terms. """
+        coefficients = term_coefficients(value)
+        instrumentation = _instrumentation
+        for term, coefficient in iter_items(terms):
+            numbers_in_common = Counter()
+            for number in numbers_in(term.canonical.numbers_mask):
+                # The index values are dicts used as ordered sets: count their keys
+                numbers_in_common.update(self.terms_by_number.get(number, {}).keys())
+            candidates = [indexed_term for indexed_term, count in numbers_in_common.items() if count == 1]
+            for indexed_term in candidates:
+                product = indexed_term * term if indexed_first else term * indexed_term
+                yield from iter_scaled_items(product, coefficients[indexed_term] * coefficient)
+            if instrumentation is not None:
+                instrumentation.record_zero('two_or_more_numbers_in_common', len(numbers_in_common) - len(candidates))
+                instrumentation.record_zero('no_numbers_in_common', len(coefficients) - len(numbers_in_common))
+
+
+class IncrementalNFoldProduct(NFoldProduct):
+    """ NFoldProduct whose inputs can be changed after entries were computed.
+
+    Every entry is multilinear in the inputs, since products distribute over sums and cobound is applied
+    term-wise. A change d of x_m therefore changes every entry x_ij with i <= m <= j by the same entry computed
+    with x_m replaced by d: the products only involve the changed summands and the cached entries of the
+    intervals not containing m. update() adds these deltas to the computed entries; the entries not yet
+    computed are computed from the changed inputs when accessed. The cached entries multiplied with the deltas
+    get a NumberIndex, kept up to date by update(), so an update only reads the terms the delta can multiply.
+    """
+    def __init__(self, *inputs: Union[Term, SumOfTerms]):
+        super().__init__(*inputs)
+        self.number_indexes = dict()
+
+    def number_index(self, i: int, j: int) -> NumberIndex:
+        if (i, j) not in self.number_indexes:
+            self.number_indexes[i, j] = NumberIndex(self.entries[i, j])
+        return self.number_indexes[i, j]
+
+    def update(self, index: int, delta: Union[Term, SumOfTerms]):
+        """ Add the delta (which may have negative coefficients) to the input x_index. """
+        if not 1 <= index <= self.n:
+            raise IndexError(f'No input x_{index} in a {self.n}-fold product')
+        deltas = {(index, index): delta}
+        for length in range(1, self.n):
+            for i in range(max(1, index - length), min(index, self.n - length) + 1):
+                j = i + length
+                if (i, j) not in self.entries:
+                    continue
+                products = [self.number_index(k + 1, j).iter_products(deltas[i, k], self.entries[k + 1, j], False)
+                            if index <= k else
+                            self.number_index(i, k).iter_products(deltas[k + 1, j], self.entries[i, k], True)
+                            for k in range(i, j)]
+                deltas[i, j] = self.combine_entry(i, j, products)
+
+        for (i, j), entry_delta in deltas.items():
+            # A new sum, since the entries may be shared with the caller (the inputs, or results handed out earlier)
+            entry = self.entries[i, j]
+            entry = entry.copy() if isinstance(entry, SumOfTerms) else SumOfTerms().add_term(entry)
+            number_index = self.number_indexes.get((i, j))
+            for term, coefficient in iter_items(entry_delta):
+                was_present = term in entry.coefficients
+                entry.add_term(term, coefficient)
+                if number_index is not None and was_present != (term in entry.coefficients):
+                    if was_present:
+                        number_index.remove(term)
+                    else:
+                        number_index.add(term)
+            # Like in a full computation, only the entries of the longer intervals are always sums
+            self.entries[i, j] = collapse_sum(entry) if j - i <= 1 else entry
+
+    def add_terms(self, index: int, terms: Union[Term, SumOfTerms]):
+        self.update(index, terms)
+
+    def remove_terms(self, index: int, terms: Union[Term, SumOfTerms]):
+        """ Remove summands from the input x_index, which must contain them. """
+        removed_terms = SumOfTerms().add_term(terms)
+        current_coefficients = term_coefficients(self.entries[index, index])
+        for term, coefficient in removed_terms.items():
+            if current_coefficients.get(term, 0) < coefficient:
+                raise ValueError(f'Term {str(term)} is not in x_{index}')
+        self.update(index, SumOfTerms().add_term(removed_terms, -1))
+
+
+FOURFOLD_ENTRIES = ((1, 2), (2, 3), (3, 4), (1, 3), (2, 4), (1, 4))
+
+
+class FourfoldSession(IncrementalNFoldProduct):
+    """ Incremental fourfold(): change the inputs with add_terms() and remove_terms() (indices 1 to 4),
+        and get the updated results in the order of fourfold() from results(). """
+    def __init__(self, x1: Union[Term, SumOfTerms], x2: Union[Term, SumOfTerms],
+                 x3: Union[Term, SumOfTerms], x4: Union[Term, SumOfTerms]):
+        super().__init__(x1, x2, x3, x4)
+
+    def results(self) -> tuple:
+        return tuple(self[index] for index in FOURFOLD_ENTRIES)
+
+
+def timed_call(function, *args):
+    """ Call a function and return its result together with the elapsed wall-clock time in seconds. """
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+class WavefrontScheduler:
+    """ Evaluate the entries of an NFoldProduct wave by wave on a thread or process pool.
+
+    All entries x_ij with the same interval length j - i only depend on shorter intervals,
+    so every product x_ik * x_(k+1)j of a wave is submitted to the executor at once;
+    the products of each entry are then summed and cobounded in the calling thread.
+    With a ProcessPoolExecutor the operands and products are sent frozen (see freeze_product()),
+    and the products are computed in the modes that carry over to the workers (see frozen_term_pairs_task()).
+    Wall-clock times are recorded in `timings`, keyed by ('multiply', i, k, j) for every product,
+    ('cobound', i, j) for every entry and ('wave', length) for every wave.
+    """
+    def __init__(self, executor: Executor):
+        self.executor = executor
+        self.timings = dict()
+
+    def submit_product(self, first_factor: Union[Term, SumOfTerms], second_factor: Union[Term, SumOfTerms]):
+        if isinstance(self.executor, ProcessPoolExecutor):
+            return self.executor.submit(timed_call, *frozen_term_pairs_task(freeze_product(first_factor),
+                                                                            freeze_product(second_factor)))
+        return self.executor.submit(timed_call, multiply_terms, first_factor, second_factor)
+
+    def collect_product(self, future) -> Tuple[Union[Term, SumOfTerms], float]:
+        product, elapsed = future.result()
+        if isinstance(self.executor, ProcessPoolExecutor):
+            product = thaw_product(collect_frozen_term_pairs(product))
+        return product, elapsed
+
+    def run(self, product: NFoldProduct, index: Optional[Tuple[int, int]] = None) -> NFoldProduct:
+        """ Compute every missing entry needed for x_ij (by default x_1n) of the product. """
+        i, j = index if index is not None else (1, product.n)
+        for length in range(1, j - i + 1):
+            wave_start = time.perf_counter()
+            wave = [(start, start + length) for start in range(i, j - length + 1)
+                    if (start, start + length) not in product.entries]
+            futures = {(start, end): [self.submit_product(product.entries[start, k], product.entries[k + 1, end])
+                                      for k in range(start, end)]
+                       for start, end in wave}
+            for (start, end), entry_futures in futures.items():
+                products = list()
+                for k, future in enumerate(entry_futures, start=start):
+                    multiplication_product, elapsed = self.collect_product(future)
+                    self.timings['multiply', start, k, end] = elapsed
+                    products.append(multiplication_product)
+                product.entries[start, end], self.timings['cobound', start, end] = \
+                    timed_call(product.combine_entry, start, end, products)
+            self.timings['wave', length] = time.perf_counter() - wave_start
+        return product
 
 
 def fourfold(x1: Union[Term, SumOfTerms],
              x2: Union[Term, SumOfTerms],
              x3: Union[Term, SumOfTerms],
-             x4: Union[Term, SumOfTerms]):
-    """ The main fourfold function. """
-    x12 = cobound(x1 * x2)
-    x23 = cobound(x2 * x3)
-    x34 = cobound(x3 * x4)
-    x13 = cobound((x1 * x23) + (x12 * x3))
-    x24 = cobound((x2 * x34) + (x23 * x4))
-    x14 = (x1 * x24) + (x12 * x34) + (x13 * x4)
-    return x12, x23, x34, x13, x24, x14
-
-
-def main():
-    x1 = Term(superscript={6}, subscript={1, 3, 5})
-    x2 = Term(superscript={7}, subscript={2, 4, 6})
-    x3 = Term(superscript={10}, subscript={7, 8, 9})
-    x4 = Term(superscript={10}, subscript={11, 12, 13})
-    # x5 = Term(superscript={13}, subscript={7, 11, 12}, concatenated_terms=[x3,x4]) - concatenation syntax
-
-    x12, x23, x34, x13, x24, x14 = fourfold(x1, x2, x3, x4)
-    print('Reprs:')
-    print(f'x12 = {repr(x12)}')
-    print(f'x23 = {repr(x23)}')
-    print(f'x34 = {repr(x34)}')
-    print(f'x13 = {repr(x13)}')
-    print(f'x24 = {repr(x24)}')
-    print(f'x14 = {repr(x14)}')
-
-    print('\nStrs:')
-    print(f'x12 = {str(x12)}')
-    print(f'x23 = {str(x23)}')
-    print(f'x34 = {str(x34)}')
-    print(f'x13 = {str(x13)}')
-    print(f'x24 = {str(x24)}')
-    print(f'x14 = {str(x14)}')
-
-
-if __name__ == '__main__':
-    main()
+             x4: Union[Term, SumOfTerms],
+             executor: Optional[Executor] = None):
+    """ The main fourfold function. If an executor is given, independent products run on it in waves,
+        and the ('multiply', i, k, j) and ('wave', length) timings of the WavefrontScheduler are recorded
+        in the installed Instrumentation, if any (which times the cobounds itself). """
+    product = NFoldProduct(x1, x2, x3, x4)
+    if executor is not None:
+        scheduler = WavefrontScheduler(executor)
+        scheduler.run(product)
+        instrumentation = _instrumentation
+        if instrumentation is not None:
+            for key, seconds in scheduler.timings.items():
+                if key[0] != 'cobound':
+                    instrumentation.record_timing(key, seconds)
+    return tuple(product[index] for index in FOURFOLD_ENTRIES)
+
+
+def initialize_batch_worker(cache_maxsize: Optional[int], modulus: Optional[int] = None,
+                            shared_cache: Optional[PersistentProductCache] = None):
+    """ Process pool initializer for fourfold_batch(): one product cache per worker (or the shared persistent
+        cache, closed when the worker exits), serial products, and the coefficient ring of the calling process. """
+    set_parallel_multiplication(None)
+    if shared_cache is not None:
+        set_product_cache(shared_cache)
+        # Workers exit without running atexit handlers, but with the finalizers of multiprocessing
+        multiprocessing.util.Finalize(shared_cache, shared_cache.close, exitpriority=0)
+    else:
+        set_product_cache(ProductCache(maxsize=cache_maxsize) if cache_maxsize is not None else None)
+    set_coefficient_ring(CoefficientRing(modulus) if modulus is not None else None)
+
+
+def fourfold_frozen(frozen_quadruple):
+    """ Process pool task: fourfold() on frozen (picklable) inputs, returning frozen results. """
+    return tuple(freeze_product(result) for result in fourfold(*map(thaw_product, frozen_quadruple)))
+
+
+def fourfold_frozen_instrumented(frozen_quadruple):
+    """ Process pool task: fourfold_frozen() under a fresh Instrumentation, returned along with the results. """
+    with Instrumentation() as instrumentation:
+        frozen_results = fourfold_frozen(frozen_quadruple)
+    return frozen_results, instrumentation
+
+
+def fourfold_batch(quadruples: Iterable[Tuple[Union[Term, SumOfTerms], ...]],
+                   max_workers: int = 0,
+                   max_pending: Optional[int] = None,
+                   cache: Optional[ProductCache] = None,
+                   instrumentation: Optional[Instrumentation] = None) -> Iterator[Tuple[Union[Term, SumOfTerms], ...]]:
+    """ Evaluate fourfold() over an iterable of quadruples, lazily yielding the results in input order.
+
+    With max_workers > 0 the quadruples are evaluated in a process pool, with at most max_pending
+    (by default twice the number of workers) submitted and not yet yielded at any time,
+    so neither the inputs nor the results are held in memory all at once.
+    The cache is shared by every fourfold() call in the batch; in a process pool, each worker
+    keeps its own cache of the same size instead, unless it is a PersistentProductCache, which all workers share.
+    The instrumentation, if given, is installed for every fourfold() call; in a process pool,
+    the workers' counts and timings are merged into it.
+    """
+    if max_workers <= 0:
+        for quadruple in quadruples:
+            previous_cache = set_product_cache(cache) if cache is not None else None
+            previous_instrumentation = set_instrumentation(instrumentation) if instrumentation is not None else None
+            try:
+                results = fourfold(*quadruple)
+            finally:
+                if cache is not None:
+                    set_product_cache(previous_cache)
+                if instrumentation is not None:
+                    set_instrumentation(previous_instrumentation)
+            yield results
+        return
+
+    def collect(future) -> Tuple[Union[Term, SumOfTerms], ...]:
+        if instrumentation is None:
+            return tuple(map(thaw_product, future.result()))
+        frozen_results, worker_instrumentation = future.result()
+        instrumentation.merge(worker_instrumentation)
+        return tuple(map(thaw_product, frozen_results))
+
+    task = fourfold_frozen if instrumentation is None else fourfold_frozen_instrumented
+    max_pending = max_pending or 2 * max_workers
+    shared_cache = cache if isinstance(cache, PersistentProductCache) else None
+    cache_maxsize = cache.maxsize if cache is not None and shared_cache is None else None
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=initialize_batch_worker,
+                             initargs=(cache_maxsize, current_modulus(), shared_cache)) as executor:
+        pending = deque()
+        for quadruple in quadruples:
+            pending.append(executor.submit(task, tuple(map(freeze_product, quadruple))))
+            if len(pending) >= max_pending:
+                yield collect(pending.popleft())
+        while pending:
+            yield collect(pending.popleft())
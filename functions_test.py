@@ -1,5 +1,18 @@
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import copy
+import io
+import pickle
+import sqlite3
+
 import pytest
-from functions import Term, cobound, fourfold
+import functions
+from functions import Term, CanonicalTerm, FlatTerm, SumOfTerms, ProductCache, ParallelMultiplication, bitmask, \
+    count_bits, Instrumentation, NoCommonNumbersWarning, ElementaryTable, CoefficientRing, PersistentProductCache, \
+    NFoldProduct, FourfoldSession, WavefrontScheduler, cobound, multiply_single_terms, iter_products, iter_cobound, \
+    select_elementary_rule, ELEMENTARY_RULES, multiply_term_pairs, multiply_elementary_term_pairs, deepcopy_term, \
+    reverse_tree, build_term, fourfold, fourfold_batch
+from serialization import TermReader, TermWriter
 
 term_zero = Term(is_zero=True)
 term_1 = Term(subscript={1}, superscript={2, 3, 4})
@@ -66,6 +79,236 @@ class TestMultiplication:
         assert term_5 * term_4 == term_5x4
 
 
+chain_1 = Term(superscript={1}, subscript={2, 3},
+               concatenated_terms=[Term(superscript={4}, subscript={5, 6},
+                                        concatenated_terms=[Term(superscript={7}, subscript={8, 9})])])
+chain_2 = Term(superscript={11}, subscript={12, 13},
+               concatenated_terms=[Term(superscript={14}, subscript={15, 16},
+                                        concatenated_terms=[Term(superscript={17}, subscript={4, 18},
+                                                                 concatenated_terms=[Term(superscript={19},
+                                                                                          subscript={20, 21})])])])
+chain_1x2 = Term(superscript={1}, subscript={2, 3},
+                 concatenated_terms=[Term(subscript={5, 6},
+                                          concatenated_terms=[
+                                              Term(superscript={17}, subscript={4, 18},
+                                                   concatenated_terms=[
+                                                       Term(superscript={19}, subscript={20, 21}),
+                                                       Term(superscript={14}, subscript={15, 16},
+                                                            concatenated_terms=[Term(superscript={11},
+                                                                                     subscript={12, 13})])]),
+                                              Term(superscript={7}, subscript={8, 9})])])
+
+
+class TestConcatenationChains:
+    def test_multiply_chains(self):
+        assert chain_1 * chain_2 == chain_1x2
+
+    def test_inputs_are_not_modified(self):
+        chain_1_str, chain_2_str = str(chain_1), str(chain_2)
+        chain_1 * chain_2
+        chain_2 * chain_1
+        assert (str(chain_1), str(chain_2)) == (chain_1_str, chain_2_str)
+
+    def test_ancestor_links(self):
+        product = chain_1 * chain_2
+        nodes = [product]
+        while nodes:
+            node = nodes.pop()
+            for concat_term in node.concatenated_terms:
+                assert concat_term.ancestor is node
+                nodes.append(concat_term)
+
+
+def deep_chain(depth):
+    chain = Term(superscript={2 * depth + 1}, subscript={2 * depth})
+    for level in reversed(range(depth)):
+        chain = Term(superscript={2 * level + 1}, subscript={2 * level}, concatenated_terms=[chain])
+    return chain
+
+
+class TestNumberIndex:
+    def test_search_uses_index(self):
+        chain = deepcopy_term(chain_2)
+        assert chain.search_term_by_number(18) is chain.concatenated_terms[0].concatenated_terms[0]
+        assert chain.number_index[11] is chain
+        assert chain.search_term_by_number(99) is None
+
+    def test_index_follows_cobound(self):
+        term = Term(superscript={4}, subscript={1, 2}, concatenated_terms=[Term(subscript={3, 5, 6})])
+        assert term.search_term_by_number(6).superscript == Counter()
+        assert term.get_total_numbers(recursive=True)[6] == 1
+        cobound_result = cobound(term)
+        assert cobound_result.search_term_by_number(6).superscript == Counter({6: 1})
+        assert cobound_result.search_term_by_number(6).ancestor is cobound_result
+        assert term.search_term_by_number(6).superscript == Counter()
+
+    def test_index_follows_reverse_tree(self):
+        chain = deepcopy_term(chain_2)
+        assert chain.number_index[20].ancestor.ancestor.ancestor is chain
+        reversed_chain = reverse_tree(chain.search_term_by_number(15))
+        assert reversed_chain.search_term_by_number(11).ancestor is reversed_chain
+        assert reversed_chain.concatenated_terms[-1] == Term(superscript={11}, subscript={12, 13})
+        assert reversed_chain.number_index.keys() == chain.number_index.keys()
+        assert chain.search_term_by_number(15).ancestor is chain
+        assert chain == chain_2
+
+    def test_total_numbers_are_not_shared(self):
+        chain = deepcopy_term(chain_1)
+        chain.get_total_numbers(recursive=True).clear()
+        assert len(chain.get_total_numbers(recursive=True)) == 9
+
+
+class TestImmutableTerm:
+    def test_term_cannot_be_modified(self):
+        term = deepcopy_term(chain_2)
+        with pytest.raises(AttributeError):
+            term.subscript = Counter({1: 1})
+        with pytest.raises(TypeError):
+            term.subscript[1] = 1
+        with pytest.raises(TypeError):
+            term.superscript.update({1: 1})
+        assert isinstance(term.concatenated_terms, tuple)
+        assert term == chain_2
+
+    def test_pickle_and_copy(self):
+        assert pickle.loads(pickle.dumps(chain_2)) == chain_2
+        assert copy.deepcopy(chain_2) == chain_2 and copy.deepcopy(chain_2) is not chain_2
+
+    def test_build_term(self):
+        term = build_term([(-1, {1}, {2}), (0, {3}, ()), (0, {4}, ()), (2, {5}, {6})])
+        assert term == Term(superscript={2}, subscript={1}, concatenated_terms=[
+            Term(subscript={3}), Term(subscript={4}, concatenated_terms=[Term(superscript={6}, subscript={5})])])
+        assert term.concatenated_terms[1].concatenated_terms[0].ancestor is term.concatenated_terms[1]
+
+
+class TestFlatTerm:
+    def test_round_trip(self):
+        flat_x14 = FlatTerm.from_term(x14.terms[0])
+        assert len(flat_x14) == 4
+        assert flat_x14.to_term() == x14.terms[0]
+        assert flat_x14.to_canonical() is x14.terms[0].canonical
+        assert FlatTerm.from_canonical(chain_1x2.canonical) == FlatTerm.from_term(chain_1x2)
+
+    def test_search_and_reroot(self):
+        flat_chain = FlatTerm.from_term(chain_2)
+        node = flat_chain.search_node_by_number(18)
+        assert node == 2
+        rerooted_chain = reverse_tree(deepcopy_term(chain_2).search_term_by_number(18))
+        assert flat_chain.reroot(node).to_term() == rerooted_chain
+
+    def test_nullify(self):
+        flat_chain = FlatTerm.from_term(chain_1)
+        flat_chain.nullify()
+        assert flat_chain.to_term() == term_zero
+
+    def test_deep_chain(self):
+        chain = deep_chain(5000)
+        flat_chain = FlatTerm.from_term(chain)
+        assert flat_chain.to_canonical() is chain.canonical
+        assert flat_chain.search_node_by_number(9001) == 4500
+        assert len(flat_chain.reroot(4500)) == 5001
+        copied_chain = deepcopy_term(chain)
+        assert copied_chain == chain
+        reversed_chain = reverse_tree(copied_chain.search_term_by_number(9001))
+        assert reversed_chain.canonical is flat_chain.reroot(4500).to_canonical()
+        assert len(chain.get_total_numbers(recursive=True)) == 10002
+
+    def test_print_deep_chain(self):
+        chain = deep_chain(20000)
+        assert str(chain).startswith('e^{1}_{0}~e^{3}_{2}~')
+        assert str(chain).endswith('~e^{40001}_{40000}')
+        assert repr(chain).startswith('Term(superscript={1}, subscript={0}, concatenated_terms=[Term(superscript={3}')
+        assert repr(chain).endswith('Term(superscript={40001}, subscript={40000})' + '])' * 20000)
+
+    def test_index_sets_are_packed(self):
+        flat_chain = FlatTerm.from_term(chain_2)
+        assert flat_chain.numbers.typecode == flat_chain.bounds.typecode == 'q'
+        assert [flat_chain.subscript(index) for index in range(len(flat_chain))] == \
+            [[12, 13], [15, 16], [4, 18], [20, 21]]
+        assert [flat_chain.superscript(index) for index in range(len(flat_chain))] == [[11], [14], [17], [19]]
+
+
+class TestCanonical:
+    def test_masks_grow_with_the_count_of_numbers(self):
+        first_term = Term(superscript={10 ** 8}, subscript={-1, 3 * 10 ** 6})
+        second_term = Term(subscript={10 ** 8})
+        assert count_bits(first_term.canonical.numbers_mask) == 3
+        assert first_term.canonical.numbers_mask.bit_length() < 10 ** 6
+        assert str(first_term * second_term) == 'e_{-1,3000000}~e_{100000000}'
+        assert FlatTerm.from_term(first_term).to_term() == first_term
+
+    def test_identical_terms_share_canonical_form(self):
+        assert x12.canonical is cobound_result_x12.canonical
+        assert hash(x12) == hash(cobound_result_x12)
+
+    def test_zero_canonical_form(self):
+        assert term_zero.canonical is Term(is_zero=True).canonical
+
+    def test_canonical_form_is_immutable(self):
+        with pytest.raises(AttributeError):
+            term_1.canonical.subscript = (5,)
+
+    def test_to_term_round_trip(self):
+        assert x13.canonical.to_term() == x13
+
+    def test_number_masks(self):
+        assert x12.canonical.subscript_mask == bitmask({4, 8, 9})
+        assert x12.canonical.superscript_mask == bitmask({10})
+        assert count_bits(x12.canonical.numbers_mask) == 7
+
+    def test_canonical_form_follows_cobound(self):
+        term = Term(superscript={4}, subscript={1, 2}, concatenated_terms=[Term(subscript={3, 5, 6})])
+        canonical_before = term.canonical
+        cobound_result = cobound(term)
+        assert term.canonical is canonical_before
+        assert cobound_result.canonical is not canonical_before
+        assert str(cobound_result.canonical.to_term()) == str(cobound_result)
+
+
+class TestSumOfTerms:
+    def test_duplicates_are_merged(self):
+        assert len(x24) == 1
+        assert x24.coefficients == {x24.terms[0]: 2}
+
+    def test_zero_terms_are_dropped(self):
+        assert len(SumOfTerms((term_zero, term_1, term_zero))) == 1
+
+    def test_equality_ignores_order(self):
+        assert term_1 + term_2 == term_2 + term_1
+
+    def test_add_zero_term(self):
+        assert SumOfTerms((term_1, term_2)) + term_zero == term_1 + term_2
+
+    def test_negative_coefficients(self):
+        negative_sum = SumOfTerms().add_term(term_1, -1).add_term(term_2, 2)
+        assert repr(negative_sum) == f'-1*({term_1}) + 2*({term_2})'
+        assert repr(term_1 + term_3) == f'{repr(term_1)} + {repr(term_3)}'
+        assert str(negative_sum) == f'-1*({term_1}) + 2*({term_2})'
+        with pytest.raises(ValueError):
+            negative_sum.terms
+
+    def test_add_returns_a_new_sum(self):
+        first_sum = SumOfTerms((term_1,))
+        total = first_sum + term_2
+        assert len(first_sum) == 1
+        assert total == term_1 + term_2
+        first_sum += term_2
+        assert first_sum == total
+
+    def test_sum_product_skips_pairs_without_one_common_number(self):
+        first_sum = SumOfTerms((x1, x2))
+        second_sum = SumOfTerms((*x3.terms, x4, term_5))
+        expected_product = SumOfTerms()
+        for first in first_sum.terms:
+            for second in second_sum.terms:
+                expected_product.add_term(multiply_single_terms(first, second))
+        with Instrumentation() as instrumentation:
+            assert first_sum * second_sum == expected_product
+        assert instrumentation.zero_reasons['no_numbers_in_common'] == 3
+        assert instrumentation.zero_reasons['two_or_more_numbers_in_common'] == 1
+        assert instrumentation.warning_count == 0
+
+
 cobound_term_1 = Term(subscript={1, 2, 3})
 cobound_result_1 = Term(superscript={3}, subscript={1, 2})
 
@@ -84,6 +327,27 @@ cobound_result_x23 = Term(superscript={3}, subscript={1, 2},
                           concatenated_terms=[Term(superscript={7}, subscript={4, 5, 6})])
 
 
+class TestStreaming:
+    def test_inputs_are_not_changed(self):
+        inputs = (x1, x2, x3, x4)
+        strings_before = [str(x) for x in inputs]
+        canonicals_before = [[term.canonical for term, _ in functions.iter_items(x)] for x in inputs]
+        fourfold(*inputs)
+        cobound(x2 * x3)
+        assert [str(x) for x in inputs] == strings_before
+        assert [[term.canonical for term, _ in functions.iter_items(x)] for x in inputs] == canonicals_before
+
+    def test_products_match_multiply_terms(self):
+        assert SumOfTerms().add_items(iter_products(x2, x3)) == SumOfTerms().add_term(x2 * x3)
+        assert SumOfTerms().add_items(iter_products(iter_products(x1, x2), x3)) == \
+            SumOfTerms().add_term((x1 * x2) * x3)
+
+    def test_cobounds_stream_into_writer(self):
+        stream = io.BytesIO()
+        TermWriter(stream).write_items(iter_cobound(iter_products(x2, x3)))
+        assert TermReader(stream.getvalue()).read() == SumOfTerms().add_term(cobound(x2 * x3))
+
+
 class TestCombination:
     def test_cobound_and_multiplication_simple(self):
         assert cobound(x1 * x2) == cobound_result_x12
@@ -92,6 +356,320 @@ class TestCombination:
         assert cobound(x2 * x3) == cobound_result_x23
 
 
+class TestProductCache:
+    def test_repeated_product_hits_cache(self):
+        with ProductCache() as cache:
+            assert x1 * x2 == x1 * x2
+        assert cache.hits == 1
+
+    def test_cached_results_are_independent(self):
+        with ProductCache():
+            cobound(x1 * x2)
+            assert x1 * x2 == Term(superscript={10}, subscript={4, 8, 9},
+                                   concatenated_terms=[Term(subscript={1, 2, 3})])
+
+    def test_reentrant(self):
+        outer_cache, inner_cache = ProductCache(), ProductCache()
+        with outer_cache:
+            with inner_cache:
+                with outer_cache:
+                    assert functions._product_cache is outer_cache
+                assert functions._product_cache is inner_cache
+            assert functions._product_cache is outer_cache
+        assert functions._product_cache is None
+
+    def test_lru_eviction(self):
+        with ProductCache(maxsize=1) as cache:
+            x1 * x2
+            x2 * x3
+            x1 * x2
+        assert cache.hits == 0
+        assert len(cache) == 1
+
+    def test_cached_cobound_is_fresh(self):
+        with ProductCache() as cache:
+            first_cobound = cobound(Term(subscript={1, 2, 3}))
+            second_cobound = cobound(Term(subscript={1, 2, 3}))
+        assert first_cobound == second_cobound == cobound_result_1
+        assert first_cobound is not second_cobound
+        assert cache.hits == 1
+
+    def test_fourfold_with_cache(self):
+        with ProductCache():
+            results = fourfold(x1, x2, x3, x4)
+            assert fourfold(x1, x2, x3, x4) == results
+        assert str(results[-1]) == str(x14)
+
+
+class TestInstrumentation:
+    def test_counts_of_threads_add_up(self):
+        instrumentation = Instrumentation()
+
+        def record_rules(_):
+            for _ in range(10000):
+                instrumentation.record_rule('equal_superscripts')
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(record_rules, range(4)))
+        assert instrumentation.rule_hits['equal_superscripts'] == 40000
+
+    def test_rule_hits_and_zero_reasons(self):
+        with Instrumentation() as instrumentation:
+            term_3 * term_5
+            term_3 * term_4
+            term_1 * term_2
+        assert instrumentation.rule_hits == Counter({'second_subscript_in_first_subscript': 1,
+                                                     'subscripts_coincide': 1})
+        assert instrumentation.zero_reasons == Counter({'subscripts_coincide': 1,
+                                                        'two_or_more_numbers_in_common': 1})
+
+    def test_fourfold_timings(self):
+        with Instrumentation() as instrumentation:
+            fourfold(x1, x2, x3, x4)
+        assert ('entry', 1, 4) in instrumentation.timings
+        assert ('cobound', 2, 4) in instrumentation.timings
+        assert ('cobound', 1, 4) not in instrumentation.timings
+        assert instrumentation.timings['entry', 1, 2][1] == 1
+        # Only the cobound() calls are timed, not the products of the entry
+        assert instrumentation.timings['cobound', 2, 4][0] < instrumentation.timings['entry', 2, 4][0]
+        assert instrumentation.report()['warning_count'] == instrumentation.warning_count
+
+    def test_collects_limited_warnings(self):
+        with Instrumentation(max_warnings=1) as instrumentation:
+            x1 * x4
+            x2 * x4
+        assert instrumentation.warning_count == 2
+        assert len(instrumentation.warnings) == 1
+        assert instrumentation.zero_reasons['no_numbers_in_common'] == 2
+
+    def test_warning_category(self):
+        with pytest.warns(NoCommonNumbersWarning, match='between e\\^\\{10\\}'):
+            assert x1 * x4 == term_zero
+
+    def test_warning_points_at_the_caller(self):
+        with ProductCache(), pytest.warns(NoCommonNumbersWarning) as records:
+            x1 * x4
+        assert records[0].filename == __file__
+
+
+elementary_sum_1 = SumOfTerms((Term(subscript={6, 7}), Term(subscript={1, 2}), Term(superscript={9}, subscript={4}),
+                               Term(superscript={8}, subscript={11}), Term(superscript={8}, subscript={4, 10})))
+elementary_sum_2 = SumOfTerms((Term(subscript={4, 8}), Term(superscript={9}, subscript={7, 8}), Term(subscript={5, 11}),
+                               Term(superscript={7}, subscript={10}), Term(superscript={11}, subscript={1})))
+
+
+@pytest.mark.skipif(functions.numpy is None, reason='numpy is not installed')
+class TestVectorizedMultiplication:
+    def test_matches_serial_products(self, monkeypatch):
+        monkeypatch.setattr(functions, 'VECTORIZED_BLOCK_SIZE', 3)
+        monkeypatch.setattr(functions, 'VECTORIZED_CANDIDATE_BLOCK_SIZE', 2)
+        first_terms, second_terms = list(elementary_sum_1.items()), list(elementary_sum_2.items())
+        with Instrumentation() as serial_instrumentation:
+            serial_product = multiply_term_pairs(first_terms, second_terms)
+        with Instrumentation() as vectorized_instrumentation:
+            vectorized_product = multiply_elementary_term_pairs(first_terms, second_terms)
+        assert str(vectorized_product) == str(serial_product)
+        assert vectorized_instrumentation.rule_hits == serial_instrumentation.rule_hits
+        assert vectorized_instrumentation.zero_reasons == serial_instrumentation.zero_reasons
+
+    def test_used_by_multiply_terms(self, monkeypatch):
+        serial_product = elementary_sum_1 * elementary_sum_2
+        monkeypatch.setattr(functions, 'VECTORIZED_THRESHOLD', 1)
+        monkeypatch.setattr(functions, 'multiply_term_pairs', None)
+        assert elementary_sum_1 * elementary_sum_2 == serial_product
+
+    def test_no_applicable_rule(self):
+        with pytest.raises(ValueError):
+            multiply_elementary_term_pairs([(term_1, 1)], [(Term(superscript={7}, subscript={3, 5, 6}), 1)])
+
+
+class TestElementaryTable:
+    def test_products_and_cobounds_are_stored(self):
+        with ElementaryTable(universe=13) as table:
+            results = fourfold(x1, x2, x3, x4)
+            assert fourfold(x1, x2, x3, x4) == results
+        assert table.rules
+        assert table.rules[table.term_id(x1) * len(table) + table.term_id(x2)] == \
+            ELEMENTARY_RULES.index('second_superscript_in_first_subscript')
+        assert str(results[-1]) == str(x14)
+        assert table.cobounds[table.term_id(cobound_term_1)] == table.term_id(cobound_result_1)
+
+    def test_precompute(self):
+        table = ElementaryTable(universe=5, max_subscript=2)
+        table.precompute()
+        rules = table.rules.tobytes()
+        with table:
+            assert term_3 * term_5 == term_3x5
+            assert cobound(Term(subscript={1, 2, 3})) == cobound_result_1
+        assert table.rules.tobytes() == rules
+
+    @pytest.mark.skipif(functions.numpy is None, reason='numpy is not installed')
+    def test_precompute_matches_rules(self):
+        table = ElementaryTable(universe=6, max_subscript=2)
+        table.precompute()
+        terms = [table.term(term_id) for term_id in range(len(table))]
+        for first_id, first_term in enumerate(terms):
+            for second_id, second_term in enumerate(terms):
+                rule = select_elementary_rule(first_term.canonical, second_term.canonical)
+                assert table.rules[first_id * len(table) + second_id] == table.rule_code(rule)
+
+    def test_terms_outside_the_table(self):
+        with ElementaryTable(universe=4) as table:
+            assert term_5 * term_4 == term_5x4
+            assert cobound(Term(subscript={4, 8})) == Term(superscript={8}, subscript={4})
+        assert not table.rules
+
+    def test_rules_are_selected_on_the_nodes_of_the_ids(self):
+        table = ElementaryTable(universe=6)
+        first_term = CanonicalTerm(subscript=(1, 2), concatenated_terms=(CanonicalTerm(subscript=(3, 4)),)).to_term()
+        table.multiply(first_term, Term(subscript={3, 4}))
+        assert table.rules == {table.term_id(first_term) * len(table) + table.term_id(Term(subscript={3, 4})):
+                               ElementaryTable.NOT_APPLICABLE}
+
+    @pytest.mark.parametrize('precompute', [False, True])
+    def test_save_and_load(self, tmp_path, precompute):
+        table = ElementaryTable(universe=13, max_subscript=3 if not precompute else 2)
+        if precompute:
+            table.precompute()
+        with table:
+            results = fourfold(x1, x2, x3, x4)
+        table.save(tmp_path / 'table.bin')
+        loaded_table = ElementaryTable.load(tmp_path / 'table.bin')
+        assert loaded_table.rules == table.rules
+        assert loaded_table.cobounds == table.cobounds
+        with loaded_table:
+            assert fourfold(x1, x2, x3, x4) == results
+
+    def test_results_of_other_rules_are_dropped(self, tmp_path, monkeypatch):
+        table = ElementaryTable(universe=13)
+        with table:
+            fourfold(x1, x2, x3, x4)
+        table.save(tmp_path / 'table.bin')
+        monkeypatch.setattr(functions, 'rules_version', lambda: 'other rules')
+        loaded_table = ElementaryTable.load(tmp_path / 'table.bin')
+        assert not loaded_table.rules
+        assert loaded_table.cobounds.count(ElementaryTable.UNKNOWN) == len(loaded_table.cobounds)
+
+
+def reduced(value, modulus):
+    """ The results of a fourfold() with the coefficients reduced modulo the modulus. """
+    if not isinstance(value, SumOfTerms):
+        return value
+    reduced_sum = SumOfTerms()
+    reduced_sum.coefficients = {term: coefficient % modulus for term, coefficient in value.items()
+                                if coefficient % modulus}
+    return reduced_sum
+
+
+class TestCoefficientRing:
+    def test_identical_terms_cancel_modulo_2(self):
+        with CoefficientRing(2):
+            test_x12, test_x23, test_x34, test_x13, test_x24, test_x14 = fourfold(x1, x2, x3, x4)
+            assert SumOfTerms((term_1, term_2, term_1)) == SumOfTerms((term_2,))
+        assert test_x24 == SumOfTerms()
+        assert test_x34 == x34
+        assert test_x14 == reduced(x14, 2)
+
+    def test_absent_term_reducing_to_zero(self):
+        with CoefficientRing(2):
+            assert SumOfTerms().add_term(term_1, 2) == SumOfTerms()
+            assert SumOfTerms((term_2,)).add_term(term_1, -4) == SumOfTerms((term_2,))
+
+    @pytest.mark.parametrize('modulus', [2, 3])
+    def test_results_are_reduced_integer_results(self, modulus):
+        integer_results = fourfold(x1, x2, x3, x4)
+        with CoefficientRing(modulus):
+            assert fourfold(x1, x2, x3, x4) == tuple(reduced(result, modulus) for result in integer_results)
+
+    def test_ring_in_worker_processes(self):
+        with CoefficientRing(2):
+            results = next(fourfold_batch([(x1, x2, x3, x4)], max_workers=1))
+        assert str(results[4]) == '0'
+
+    def test_invalid_modulus(self):
+        with pytest.raises(ValueError):
+            CoefficientRing(1)
+
+
+class TestPersistentProductCache:
+    def test_warm_run_only_looks_up(self, tmp_path):
+        with PersistentProductCache(tmp_path / 'products.sqlite') as cold_cache:
+            results = fourfold(x1, x2, x3, x4)
+        assert cold_cache.misses > 0
+        with PersistentProductCache(tmp_path / 'products.sqlite') as warm_cache:
+            assert fourfold(x1, x2, x3, x4) == results
+        assert warm_cache.misses == 0
+        assert warm_cache.hits > 0
+        assert str(results[-1]) == str(x14)
+
+    def test_other_version_is_dropped(self, tmp_path):
+        with PersistentProductCache(tmp_path / 'products.sqlite', version='old') as cache:
+            x1 * x2
+        assert len(cache) > 0
+        assert len(PersistentProductCache(tmp_path / 'products.sqlite', version='new')) == 0
+        assert len(PersistentProductCache(tmp_path / 'products.sqlite', version='old')) == 0
+
+    def test_closed_when_the_outermost_block_exits(self, tmp_path):
+        with PersistentProductCache(tmp_path / 'products.sqlite') as cache:
+            with cache:
+                x1 * x2
+            assert cache._open_connections
+        assert not cache._open_connections
+
+    def test_eviction(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(PersistentProductCache, 'EVICTION_INTERVAL', 1)
+        with PersistentProductCache(tmp_path / 'products.sqlite', maxsize=2) as cache:
+            fourfold(x1, x2, x3, x4)
+            assert len(cache) == 2
+
+    def test_close_closes_the_connections_of_all_threads(self, tmp_path):
+        with PersistentProductCache(tmp_path / 'products.sqlite') as cache:
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                fourfold(x1, x2, x3, x4, executor=executor)
+            connections = [connection for _, connection in cache._open_connections]
+        assert len(connections) > 1
+        assert not cache._open_connections
+        for connection in connections:
+            with pytest.raises(sqlite3.ProgrammingError):
+                connection.execute('SELECT 1')
+
+    def test_shared_by_worker_processes(self, tmp_path):
+        cache = PersistentProductCache(tmp_path / 'products.sqlite')
+        results = list(fourfold_batch([(x1, x2, x3, x4)] * 4, max_workers=2, cache=cache))
+        assert all(str(result[-1]) == str(x14) for result in results)
+        assert len(cache) > 0
+
+    def test_worker_processes_write_their_usage_times(self, tmp_path):
+        cache = PersistentProductCache(tmp_path / 'products.sqlite')
+        with cache:
+            fourfold(x1, x2, x3, x4)
+        connection = sqlite3.connect(tmp_path / 'products.sqlite')
+        with connection:
+            connection.execute('UPDATE products SET last_used = 0')
+        list(fourfold_batch([(x1, x2, x3, x4)], max_workers=1, cache=cache))
+        assert connection.execute('SELECT COUNT(*) FROM products WHERE last_used > 0').fetchone()[0] > 0
+        connection.close()
+
+    def test_products_are_stored_in_the_binary_format(self, tmp_path):
+        with PersistentProductCache(tmp_path / 'products.sqlite') as cache:
+            product = x1 * x2
+            stored_products = [row[0] for row in cache.connection.execute('SELECT product FROM products')]
+        assert len(stored_products) == 2
+        assert all(str(TermReader(stored_product).read()) == str(product) for stored_product in stored_products)
+
+
+class TestParallelMultiplication:
+    def test_parallel_product_matches_serial(self):
+        with ParallelMultiplication(max_workers=2, threshold=1):
+            parallel_product = x34 * x2
+        assert parallel_product == x34 * x2
+
+    def test_fourfold_in_parallel(self):
+        with ParallelMultiplication(max_workers=2, threshold=1):
+            test_x12, test_x23, test_x34, test_x13, test_x24, test_x14 = fourfold(x1, x2, x3, x4)
+        assert test_x34 == x34
+        assert str(test_x14) == str(x14)
+
+
 class TestFourfold:
     def test_fourfold(self):
         test_x12, test_x23, test_x34, test_x13, test_x24, test_x14 = fourfold(x1, x2, x3, x4)
@@ -101,3 +679,111 @@ class TestFourfold:
         assert str(test_x13) == str(x13)
         assert str(test_x24) == str(x24)
         assert str(test_x14) == str(x14)
+
+
+x5 = Term(superscript={16}, subscript={13, 14, 15})
+
+
+class TestNFoldProduct:
+    def test_entries_are_lazy(self):
+        product = NFoldProduct(x1, x2, x3, x4, x5)
+        assert product[2, 4] == fourfold(x1, x2, x3, x4)[4]
+        assert set(product.entries) == {(i, i) for i in range(1, 6)} | {(2, 3), (3, 4), (2, 4)}
+
+    def test_fivefold_recurrence(self):
+        product = NFoldProduct(x1, x2, x3, x4, x5)
+        x12, x23, x34, x13, x24, _ = fourfold(x1, x2, x3, x4)
+        x14 = cobound(x1 * x24 + x12 * x34 + x13 * x4)
+        x45 = cobound(x4 * x5)
+        x35 = cobound(x3 * x45 + x34 * x5)
+        x25 = cobound(x2 * x35 + x23 * x45 + x24 * x5)
+        x15 = x1 * x25 + x12 * x35 + x13 * x45 + x14 * x5
+        assert product[1, 5] == x15
+
+    def test_too_few_inputs(self):
+        with pytest.raises(ValueError):
+            NFoldProduct(x1)
+
+
+x3_first = Term(superscript={7}, subscript={3, 5, 6})
+x3_second = Term(superscript={7}, subscript={4, 5, 6})
+
+
+class TestFourfoldSession:
+    def test_remove_and_add_summand(self):
+        session = FourfoldSession(x1, x2, x3, x4)
+        original_results = session.results()
+        session.remove_terms(3, x3_second)
+        assert session.results() == fourfold(x1, x2, x3_first, x4)
+        session.add_terms(3, x3_second)
+        assert session.results() == original_results
+        assert x3 == SumOfTerms((x3_first, x3_second))
+
+    def test_only_affected_entries_are_updated(self):
+        session = FourfoldSession(x1, x2, x3_first, x4)
+        session.results()
+        with Instrumentation() as instrumentation:
+            session.add_terms(3, x3_second)
+        assert set(instrumentation.timings) == {('cobound', 2, 3), ('cobound', 3, 4),
+                                                ('cobound', 1, 3), ('cobound', 2, 4)}
+        assert session[1, 2] == x12
+        assert str(session[1, 4]) == str(x14)
+
+    def test_update_before_computing(self):
+        session = FourfoldSession(x1, x2, x3_first, x4)
+        session.add_terms(3, x3_second)
+        assert session.results() == fourfold(x1, x2, x3, x4)
+
+    def test_remove_missing_term(self):
+        with pytest.raises(ValueError):
+            FourfoldSession(x1, x2, x3, x4).remove_terms(2, x1)
+
+
+class TestWavefrontScheduler:
+    def test_thread_pool_matches_serial(self):
+        product = NFoldProduct(x1, x2, x3, x4, x5)
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            scheduler = WavefrontScheduler(executor)
+            scheduler.run(product)
+        assert product[1, 5] == NFoldProduct(x1, x2, x3, x4, x5)[1, 5]
+        assert ('multiply', 1, 3, 5) in scheduler.timings
+        assert ('cobound', 2, 5) in scheduler.timings
+        assert ('wave', 4) in scheduler.timings
+
+    def test_fourfold_in_process_pool(self):
+        with ProcessPoolExecutor(max_workers=2) as executor, Instrumentation() as instrumentation:
+            results = fourfold(x1, x2, x3, x4, executor=executor)
+        assert ('multiply', 1, 2, 4) in instrumentation.timings
+        assert ('wave', 3) in instrumentation.timings
+        assert ('cobound', 2, 4) in instrumentation.timings
+        assert results[2] == x34
+        assert str(results[-1]) == str(x14)
+
+    def test_process_pool_workers_are_instrumented(self):
+        with Instrumentation() as serial_instrumentation:
+            fourfold(x1, x2, x3, x4)
+        with ProcessPoolExecutor(max_workers=2) as executor, Instrumentation() as instrumentation:
+            fourfold(x1, x2, x3, x4, executor=executor)
+        assert instrumentation.rule_hits == serial_instrumentation.rule_hits
+        assert instrumentation.zero_reasons == serial_instrumentation.zero_reasons
+
+    def test_process_pool_workers_share_the_persistent_cache(self, tmp_path):
+        with ProcessPoolExecutor(max_workers=2) as executor, \
+                PersistentProductCache(tmp_path / 'products.sqlite') as cache:
+            fourfold(x1, x2, x3, x4, executor=executor)
+            worker_products = cache.connection.execute(
+                "SELECT COUNT(*) FROM products WHERE key LIKE 'multiply_single_terms|%'").fetchone()[0]
+        assert worker_products > 0
+
+
+class TestFourfoldBatch:
+    def test_batch_matches_single_calls(self):
+        quadruples = [(x1, x2, x3, x4), (x2, x3, x4, x1), (x1, x2, x3, x4)]
+        expected = [fourfold(*quadruple) for quadruple in quadruples]
+        assert list(fourfold_batch(quadruples, cache=ProductCache())) == expected
+
+    def test_batch_in_process_pool(self):
+        quadruples = [(x1, x2, x3, x4)] * 5
+        results = list(fourfold_batch(iter(quadruples), max_workers=2, max_pending=2, cache=ProductCache()))
+        assert len(results) == 5
+        assert all(str(result[-1]) == str(x14) for result in results)
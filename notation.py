@@ -0,0 +1,141 @@
+import functools
+import re
+from typing import Union, Iterator, Tuple, Optional
+
+from functions import Term, SumOfTerms, build_term
+
+# The notation of Term.__str__ and SumOfTerms.__str__: summands separated by '+', each either 0, a term,
+#   or a multiple of a term such as 2*(e^{1}_{2,3}) or -1*(e^{1}_{2,3}). A term is e with an optional superscript ^{...}
+#   and subscript _{...}, followed by ~ and its only concatenated term, or by ~[...] and a comma-separated
+#   list of its concatenated terms. Whitespace is ignored, and newlines separate summands as well.
+NODE = re.compile(r'e(?:\^\{(\d+(?:,\d+)*)\})?(?:_\{(\d+(?:,\d+)*)\})?(~\[|~)?')
+MULTIPLE = re.compile(r'(-?\d+)\*\((.*)\)', re.DOTALL)
+SEPARATOR = re.compile(r'([+\n])')
+WHITESPACE = re.compile(r'\s+')
+CHUNK_SIZE = 1 << 16
+
+
+class NotationError(ValueError):
+    """ The text is not a well-formed term or sum. """
+
+
+@functools.lru_cache(maxsize=65536)
+def index_set(numbers: Optional[str]) -> tuple:
+    """ Numbers of a superscript or subscript. Inputs repeat index sets a lot, so they are parsed once. """
+    return tuple(int(number) for number in numbers.split(',')) if numbers else ()
+
+
+def parse_term(text: str) -> Term:
+    """ Parse a single term, with ancestor links. The concatenated terms are handled with an explicit
+        stack of the nodes still expecting them, so the depth of the term is not limited. """
+    text = WHITESPACE.sub('', text)
+    if text == '0':
+        return Term(is_zero=True)
+    # (Parent index, subscript, superscript) of the parsed nodes, built into a tree at the end,
+    #   and the indices of the nodes whose concatenated terms are being parsed, and whether they were listed in brackets
+    nodes = list()
+    parents = list()
+    position = 0
+    while True:
+        match = NODE.match(text, position)
+        if match is None:
+            raise NotationError(f'Expected a term at position {position} of {text!r}')
+        superscript, subscript, concatenation = match.groups()
+        nodes.append((parents[-1][0] if parents else -1, index_set(subscript), index_set(superscript)))
+        position = match.end()
+        if concatenation is not None:
+            parents.append((len(nodes) - 1, concatenation == '~['))
+            continue
+
+        # The term is complete, so are the parents of single concatenated terms above it;
+        #   a bracketed list either continues with another term or ends
+        while parents:
+            if not parents[-1][1]:
+                parents.pop()
+            elif text.startswith(',', position):
+                position += 1
+                break
+            elif text.startswith(']', position):
+                parents.pop()
+                position += 1
+            else:
+                raise NotationError(f'Expected "," or "]" at position {position} of {text!r}')
+        if not parents:
+            if position != len(text):
+                raise NotationError(f'Unexpected {text[position:position + 20]!r} after the term {text!r}')
+            return build_term(nodes)
+
+
+def parse_summand(text: str) -> Tuple[Term, int]:
+    """ Parse a term or a multiple of a term, returning the term and its coefficient. """
+    match = MULTIPLE.fullmatch(text.strip())
+    if match is None:
+        return parse_term(text), 1
+    return parse_term(match.group(2)), int(match.group(1))
+
+
+class SumParser:
+    """ Incremental parser of a sum: feed() it text in chunks of any size, and it yields
+        the (term, coefficient) pairs of every summand as soon as the summand is complete.
+        close() yields the last summand and checks that the text did not end with a dangling '+'. """
+    def __init__(self):
+        self.pending = list()
+        self.expecting_summand = False
+
+    def feed(self, chunk: str) -> Iterator[Tuple[Term, int]]:
+        # Only look for separators in the new chunk, so that long summands split over many chunks stay linear
+        end = max(chunk.rfind('+'), chunk.rfind('\n'))
+        if end < 0:
+            self.pending.append(chunk)
+            return
+        self.pending.append(chunk[:end + 1])
+        text = ''.join(self.pending)
+        self.pending = [chunk[end + 1:]]
+        yield from self.parse_summands(text)
+
+    def close(self) -> Iterator[Tuple[Term, int]]:
+        text = ''.join(self.pending)
+        self.pending = list()
+        yield from self.parse_summands(text)
+        if self.expecting_summand:
+            raise NotationError('The sum ends with "+"')
+
+    def parse_summands(self, text: str) -> Iterator[Tuple[Term, int]]:
+        pieces = SEPARATOR.split(text)
+        for index in range(0, len(pieces), 2):
+            summand = pieces[index]
+            separator = pieces[index + 1] if index + 1 < len(pieces) else None
+            if summand.strip():
+                yield parse_summand(summand)
+                self.expecting_summand = separator == '+'
+            elif separator == '+':
+                raise NotationError('Missing summand before "+"')
+
+
+def iter_summands(source) -> Iterator[Tuple[Term, int]]:
+    """ Yield the (term, coefficient) pairs of a sum given as a string or a text stream, one summand at a time. """
+    parser = SumParser()
+    if isinstance(source, str):
+        yield from parser.feed(source)
+    else:
+        while True:
+            chunk = source.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield from parser.feed(chunk)
+    yield from parser.close()
+
+
+def parse(source) -> Union[Term, SumOfTerms]:
+    """ Parse a sum from a string or a text stream. A single term with coefficient 1 is returned as a Term. """
+    summands = list()
+    value = SumOfTerms()
+    for term, coefficient in iter_summands(source):
+        if len(summands) < 2:
+            summands.append((term, coefficient))
+        value.add_term(term, coefficient)
+    if not summands:
+        raise NotationError('Empty input')
+    if len(summands) == 1 and summands[0][1] == 1:
+        return summands[0][0]
+    return value
@@ -0,0 +1,68 @@
+import io
+
+import pytest
+from functions import Term, SumOfTerms
+from functions_test import x1, x3, x12, x14, x24, chain_1x2
+from notation import NotationError, SumParser, parse, parse_term, iter_summands
+from serialization_test import ancestor_links, node_count
+
+
+class TestParseTerm:
+    def test_round_trip(self):
+        for term in (x1, x12, chain_1x2, Term(), Term(subscript={1}), Term(superscript={2})):
+            assert str(parse_term(str(term))) == str(term)
+
+    def test_ancestor_links(self):
+        term = parse_term(str(chain_1x2))
+        assert term.ancestor is None
+        assert ancestor_links(term) == ancestor_links(chain_1x2)
+
+    def test_deep_chain(self):
+        text = '~'.join(f'e_{{{number}}}' for number in range(1, 20001))
+        assert node_count(parse_term(text)) == 20000
+
+    def test_whitespace(self):
+        assert parse_term(' e^{10}_{4, 8, 9} ~ [e^{3}_{1,2}]') == x12
+
+    @pytest.mark.parametrize('text', ['', 'e^{}', 'e_{1}~', 'e~[e_{1}', 'e~[e_{1},]', 'e_{1}]', 'f', 'e_{1}e_{2}'])
+    def test_malformed(self, text):
+        with pytest.raises(NotationError):
+            parse_term(text)
+
+
+class TestParseSum:
+    def test_round_trip(self):
+        assert parse(str(x14)) == x14
+        assert parse(str(x3)) == x3
+
+    def test_multiples(self):
+        value = SumOfTerms([x1, x1, x24])
+        assert str(value).startswith('2*(')
+        assert parse(str(value)) == value
+
+    def test_negative_multiples(self):
+        value = SumOfTerms().add_term(x1, -1).add_term(x12, 3)
+        assert str(value).startswith('-1*(')
+        assert parse(str(value)) == value
+
+    def test_single_term_and_zero(self):
+        assert parse(str(x12)) == x12
+        assert parse('0').is_zero
+
+    def test_stream_in_small_chunks(self, monkeypatch):
+        monkeypatch.setattr('notation.CHUNK_SIZE', 5)
+        assert parse(io.StringIO(str(x14) + '\n' + str(x3) + '\n')) == SumOfTerms([x14, x3])
+
+    def test_incremental(self):
+        parser = SumParser()
+        assert list(parser.feed('e^{10}_{4,8,9} + e^{4}_{1,')) == [(x1, 1)]
+        assert list(parser.feed('2,3}')) == []
+        assert [str(term) for term, _ in parser.close()] == ['e^{4}_{1,2,3}']
+
+    def test_iter_summands(self):
+        assert [coefficient for _, coefficient in iter_summands('3*(e_{1}) +\n e_{2}')] == [3, 1]
+
+    @pytest.mark.parametrize('text', ['', 'e_{1} +', '+ e_{1}', 'e_{1} + + e_{2}', '2*(e_{1}'])
+    def test_malformed(self, text):
+        with pytest.raises(NotationError):
+            parse(text)
@@ -0,0 +1,257 @@
+import io
+import mmap
+from contextlib import contextmanager
+from typing import Union, Iterable, Iterator, Tuple, Optional
+
+from functions import Term, SumOfTerms, build_term
+
+# Binary format
+# -------------
+# A stream starts with MAGIC and the format VERSION, followed by any number of values.
+# A value is a kind byte (TERM_KIND or SUM_KIND) followed by term records and an end marker.
+# A term record is the coefficient (zigzag varint, never 0), the number of nodes (varint, 0 for the zero term)
+# and, for every node in depth-first order (as in FlatTerm), the index of its parent plus one (varint, 0 for
+# the root), its subscript and its superscript. An index set is its size followed by its sorted numbers,
+# the first as is and the others as the difference to the previous one (all varints).
+# A coefficient of 0 ends the value.
+MAGIC = b'MFT'
+VERSION = 1
+TERM_KIND = ord('T')
+SUM_KIND = ord('S')
+END_OF_VALUE = 0
+CHUNK_SIZE = 1 << 16
+
+
+def encode_varint(number: int, output: bytearray):
+    """ Append an unsigned LEB128 integer. """
+    while number > 0x7f:
+        output.append((number & 0x7f) | 0x80)
+        number >>= 7
+    output.append(number)
+
+
+def encode_index_set(index_set, output: bytearray):
+    numbers = sorted(index_set)
+    encode_varint(len(numbers), output)
+    previous_number = 0
+    for number in numbers:
+        encode_varint(number - previous_number, output)
+        previous_number = number
+
+
+def encode_term(term: Term, coefficient: int, output: bytearray):
+    """ Append the record of a term with its coefficient. """
+    encode_varint(coefficient << 1 if coefficient >= 0 else (-coefficient << 1) - 1, output)
+    if term.is_zero:
+        encode_varint(0, output)
+        return
+    # Same depth-first order as FlatTerm.from_term(), on the index sets themselves instead of bitmasks,
+    #   whose bits are the ids the numbers were given in this process
+    node_records = bytearray()
+    node_count = 0
+    nodes = [(term, 0)]
+    while nodes:
+        node, parent = nodes.pop()
+        node_count += 1
+        encode_varint(parent, node_records)
+        encode_index_set(node.subscript, node_records)
+        encode_index_set(node.superscript, node_records)
+        nodes.extend((concat_term, node_count) for concat_term in reversed(node.concatenated_terms))
+    encode_varint(node_count, output)
+    output += node_records
+
+
+class TermWriter:
+    """ Streaming writer of terms and sums in the binary format.
+
+    write() stores a whole Term or SumOfTerms. A sum can also be written one term at a time,
+    between begin_sum() and end_sum(), or from any iterable of (term, coefficient) pairs with write_items(),
+    so it never has to be materialized. Every record is written to the stream as soon as it is encoded.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.in_sum = False
+        stream.write(MAGIC + bytes((VERSION,)))
+
+    def write(self, value: Union[Term, SumOfTerms]):
+        if isinstance(value, SumOfTerms):
+            self.write_items(value.items())
+        else:
+            output = bytearray((TERM_KIND,))
+            encode_term(value, 1, output)
+            output.append(END_OF_VALUE)
+            self.stream.write(output)
+
+    def begin_sum(self):
+        if self.in_sum:
+            raise ValueError('A sum is already being written')
+        self.stream.write(bytes((SUM_KIND,)))
+        self.in_sum = True
+
+    def write_term(self, term: Term, coefficient: int = 1):
+        """ Add a term to the sum being written. Zero terms and zero coefficients are skipped. """
+        if not self.in_sum:
+            raise ValueError('write_term() must be called between begin_sum() and end_sum()')
+        if term.is_zero or not coefficient:
+            return
+        output = bytearray()
+        encode_term(term, coefficient, output)
+        self.stream.write(output)
+
+    def end_sum(self):
+        if not self.in_sum:
+            raise ValueError('No sum is being written')
+        self.stream.write(bytes((END_OF_VALUE,)))
+        self.in_sum = False
+
+    def write_items(self, items: Iterable[Tuple[Term, int]]):
+        """ Write a sum given as (term, coefficient) pairs. """
+        self.begin_sum()
+        for term, coefficient in items:
+            self.write_term(term, coefficient)
+        self.end_sum()
+
+
+class TermReader:
+    """ Streaming reader of the binary format.
+
+    The source is either a bytes-like object (including a memory map, which is then decoded in place,
+    see open_mapped()) or a binary stream, which is read in chunks. read() returns the next whole value,
+    and iterating over the reader returns all of them. read_items() instead yields the (term, coefficient)
+    pairs of the next value one by one, so a large sum is never held in memory as a whole.
+    """
+    def __init__(self, source):
+        try:
+            self.data = memoryview(source)
+            self.stream = None
+        except TypeError:
+            self.data = b''
+            self.stream = source
+        self.position = 0
+        if bytes(self.read_byte() for _ in MAGIC) != MAGIC:
+            raise ValueError('Not a serialized term stream')
+        version = self.read_byte()
+        if version != VERSION:
+            raise ValueError(f'Unsupported serialization format version: {version}')
+
+    def at_end(self) -> bool:
+        if self.position == len(self.data):
+            self.refill()
+        return self.position == len(self.data)
+
+    def refill(self):
+        if self.stream is not None:
+            self.data = self.data[self.position:] + self.stream.read(CHUNK_SIZE)
+            self.position = 0
+
+    def read_byte(self) -> int:
+        if self.at_end():
+            raise EOFError('Unexpected end of serialized term stream')
+        byte = self.data[self.position]
+        self.position += 1
+        return byte
+
+    def read_varint(self) -> int:
+        # Fast path for the common single-byte varints
+        position = self.position
+        if position < len(self.data):
+            byte = self.data[position]
+            if byte < 0x80:
+                self.position = position + 1
+                return byte
+        number = 0
+        shift = 0
+        while True:
+            byte = self.read_byte()
+            number |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return number
+            shift += 7
+
+    def read_index_set(self) -> list:
+        numbers = list()
+        number = 0
+        for _ in range(self.read_varint()):
+            number += self.read_varint()
+            numbers.append(number)
+        return numbers
+
+    def read_term(self) -> Term:
+        """ Read the nodes of a term record and build them into a Term tree. """
+        node_count = self.read_varint()
+        if node_count == 0:
+            return Term(is_zero=True)
+        nodes = list()
+        for _ in range(node_count):
+            parent = self.read_varint() - 1
+            subscript = self.read_index_set()
+            nodes.append((parent, subscript, self.read_index_set()))
+        return build_term(nodes)
+
+    def read_kind(self) -> int:
+        kind = self.read_byte()
+        if kind not in (TERM_KIND, SUM_KIND):
+            raise ValueError(f'Unknown value kind: {kind}')
+        return kind
+
+    def iter_records(self) -> Iterator[Tuple[Term, int]]:
+        while True:
+            coefficient = self.read_varint()
+            if coefficient == END_OF_VALUE:
+                return
+            coefficient = coefficient >> 1 if not coefficient & 1 else -((coefficient + 1) >> 1)
+            yield self.read_term(), coefficient
+
+    def read_items(self) -> Iterator[Tuple[Term, int]]:
+        """ Yield the (term, coefficient) pairs of the next value. The generator must be exhausted
+            before reading further. """
+        self.read_kind()
+        return self.iter_records()
+
+    def read(self) -> Union[Term, SumOfTerms]:
+        """ Read the next value. Raise EOFError at the end of the stream. """
+        kind = self.read_kind()
+        if kind == TERM_KIND:
+            (term, _), = self.iter_records()
+            return term
+        value = SumOfTerms()
+        for term, coefficient in self.iter_records():
+            value.add_term(term, coefficient)
+        return value
+
+    def __iter__(self):
+        while not self.at_end():
+            yield self.read()
+
+
+def dump(value: Union[Term, SumOfTerms], stream):
+    TermWriter(stream).write(value)
+
+
+def dumps(value: Union[Term, SumOfTerms]) -> bytes:
+    stream = io.BytesIO()
+    dump(value, stream)
+    return stream.getvalue()
+
+
+def load(source) -> Union[Term, SumOfTerms]:
+    """ Read the first value from a binary stream or a bytes-like object. """
+    return TermReader(source).read()
+
+
+def loads(data: bytes) -> Union[Term, SumOfTerms]:
+    return load(data)
+
+
+@contextmanager
+def open_mapped(path) -> Iterator[TermReader]:
+    """ Reader over a memory-mapped file, which the operating system pages in as it is decoded. """
+    with open(path, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            reader: Optional[TermReader] = None
+            try:
+                reader = TermReader(mapped_file)
+                yield reader
+            finally:
+                if reader is not None:
+                    reader.data.release()
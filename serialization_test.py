@@ -0,0 +1,107 @@
+import io
+
+import pytest
+from functions import Term, SumOfTerms, fourfold, deepcopy_term, build_term
+from functions_test import x1, x2, x3, x4, x14, chain_1x2
+from serialization import TermWriter, TermReader, dump, dumps, load, loads, open_mapped
+
+
+def ancestor_links(term: Term) -> list:
+    """ Pairs of (node, ancestor) strings in depth-first order, checking that every link points to the parent. """
+    links = list()
+    nodes = [term]
+    while nodes:
+        node = nodes.pop()
+        assert all(concat_term.ancestor is node for concat_term in node.concatenated_terms)
+        links.append((str(node), str(node.ancestor) if node.ancestor is not None else None))
+        nodes.extend(reversed(node.concatenated_terms))
+    return links
+
+
+def node_count(term: Term) -> int:
+    length = 0
+    nodes = [term]
+    while nodes:
+        node = nodes.pop()
+        length += 1
+        nodes.extend(node.concatenated_terms)
+    return length
+
+
+class TestRoundTrip:
+    def test_term(self):
+        term = loads(dumps(chain_1x2))
+        assert str(term) == str(chain_1x2)
+        assert term.ancestor is None
+        assert ancestor_links(term) == ancestor_links(chain_1x2)
+
+    def test_sum_with_coefficients(self):
+        value = SumOfTerms([x1, x2]).add_term(x2, 2).add_term(x3, -1)
+        assert loads(dumps(value)) == value
+
+    def test_zero_values(self):
+        assert loads(dumps(Term(is_zero=True))).is_zero
+        assert loads(dumps(SumOfTerms())) == SumOfTerms()
+
+    def test_large_numbers(self):
+        term = Term(superscript={10 ** 9}, subscript={3, 10 ** 6})
+        assert loads(dumps(term)) == term
+
+    def test_deep_chain(self):
+        root = build_term([(-1, {2}, {1})] + [(number - 3, {number}, ()) for number in range(3, 3000)])
+        assert node_count(loads(dumps(root))) == 2998
+
+    def test_fourfold_results(self):
+        results = fourfold(x1, x2, x3, x4)
+        stream = io.BytesIO()
+        writer = TermWriter(stream)
+        for result in results:
+            writer.write(result)
+        stream.seek(0)
+        loaded_results = list(TermReader(stream))
+        assert loaded_results == list(results)
+        assert str(loaded_results[-1]) == str(x14)
+
+
+class TestStreaming:
+    def test_write_and_read_term_by_term(self):
+        stream = io.BytesIO()
+        writer = TermWriter(stream)
+        writer.begin_sum()
+        for term in (x1, x2, Term(is_zero=True), deepcopy_term(x1)):
+            writer.write_term(term)
+        writer.end_sum()
+        writer.write(x4)
+        reader = TermReader(io.BytesIO(stream.getvalue()))
+        assert [(str(term), coefficient) for term, coefficient in reader.read_items()] == \
+               [(str(x1), 1), (str(x2), 1), (str(x1), 1)]
+        assert reader.read() == x4
+        with pytest.raises(EOFError):
+            reader.read()
+
+    def test_small_chunks(self, monkeypatch):
+        monkeypatch.setattr('serialization.CHUNK_SIZE', 3)
+        value = SumOfTerms([chain_1x2, x1, x4])
+        stream = io.BytesIO()
+        dump(value, stream)
+        stream.seek(0)
+        assert load(stream) == value
+
+    def test_write_term_outside_sum(self):
+        with pytest.raises(ValueError):
+            TermWriter(io.BytesIO()).write_term(x1)
+
+    def test_invalid_stream(self):
+        with pytest.raises(ValueError):
+            loads(b'not a term')
+
+    def test_memory_mapped_file(self, tmp_path):
+        path = tmp_path / 'results.bin'
+        with open(path, 'wb') as file:
+            writer = TermWriter(file)
+            writer.write(x3)
+            writer.write(chain_1x2)
+        with open_mapped(path) as reader:
+            loaded_x3, loaded_chain = reader
+        assert loaded_x3 == x3
+        assert ancestor_links(loaded_chain) == ancestor_links(chain_1x2)